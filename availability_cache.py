@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def slice_events(events, start_time, end_time):
+    """
+    Keeps events overlapping [start_time, end_time], as the BDD does. Repeatable events are kept even if they end
+    before the window, since their next occurrences may fall into it.
+    :param events: either the JSON of the player (list of events), or its events array (see core.events_to_array).
+    """
+    if isinstance(events, np.ndarray):
+        return events[((events[:, 1] > start_time) | (events[:, 2] != 0)) & (events[:, 0] < end_time)]
+    # Malformed events are kept, so that parsing reports them as it would have without the cache.
+    return [event for event in events
+            if (event.get('end', end_time) > start_time or event.get('repeatable'))
+            and event.get('start', start_time) < end_time]
+
+
+class AvailabilityCache:
+    """
+    In-process cache of the events of players (their JSON, or the events arrays core converts it to), sitting in front
+    of core.get_player_json.
+
+    There is a single entry per player, holding the events fetched for a given time window. A request for a window
+    included in the cached one is answered by slicing the cached events, so that a poll over one week following a poll
+    over four weeks does not query the BDD again. Entries expire after ttl seconds, and the least recently used entries
+    are evicted once the total number of cached events exceeds max_events (which bounds the memory used by the cache).
+    """
+    def __init__(self, ttl=300.0, max_events=200000, clock=time.monotonic):
+        """
+        :param ttl: float
+        Time (in seconds) during which a fetched calendar is considered up to date. 0 disables the cache.
+        :param max_events: int
+        Maximum number of events held by the cache, all players together.
+        :param clock: callable
+        Returns the current time in seconds. Meant to be overridden in tests.
+        """
+        self.ttl = ttl
+        self.max_events = max_events
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.n_events = 0
+        # player_id -> (start_time, end_time, events, fetched_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _count_events(events):
+        return len(events) if isinstance(events, (list, np.ndarray)) else 0
+
+    def _remove(self, player_id):
+        entry = self._entries.pop(player_id)
+        self.n_events -= self._count_events(entry[2])
+
+    def get(self, player_id, start_time, end_time):
+        """
+        Returns the cached events of the player between start_time and end_time, or None if they are not cached (or if
+        the cached entry expired or does not cover the requested window). See slice_events.
+        """
+        player_id = str(player_id)
+        with self._lock:
+            entry = self._entries.get(player_id)
+            if entry is not None and self.clock() - entry[3] > self.ttl:
+                self._remove(player_id)
+                entry = None
+            if entry is None or entry[0] > start_time or entry[1] < end_time:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(player_id)
+            self.hits += 1
+            cached_start, cached_end, events, _ = entry
+
+        if self._count_events(events) == 0 or (cached_start == start_time and cached_end == end_time):
+            return events
+        return slice_events(events, start_time, end_time)
+
+    def covers(self, player_id, start_time, end_time, margin=0.0):
+        """
+        Tells whether events of the player between start_time and end_time are cached, and will still be up to date in
+        margin seconds. Unlike get, this is counted neither as a hit nor as a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(str(player_id))
+        return entry is not None and entry[0] <= start_time and entry[1] >= end_time \
+            and self.clock() + margin - entry[3] <= self.ttl
+
+    def put(self, player_id, start_time, end_time, events):
+        """
+        Caches the events of the player fetched between start_time and end_time, replacing any previous entry of the
+        player.
+        """
+        player_id = str(player_id)
+        n_events = self._count_events(events)
+        with self._lock:
+            if player_id in self._entries:
+                self._remove(player_id)
+            if self.ttl <= 0 or n_events > self.max_events:
+                return
+            self._entries[player_id] = (start_time, end_time, events, self.clock())
+            self.n_events += n_events
+            while self.n_events > self.max_events:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_events = 0
+
+    def stats(self):
+        """
+        :return: dict of counters, meant to size the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'players': len(self._entries), 'events': self.n_events}
@@ -1,6 +1,100 @@
+import asyncio
+import logging
+import os
+import time
+import aiohttp
 import requests
 
+# Maximum time (in seconds) a single query to the BDD may take before being abandoned.
+REQUEST_TIMEOUT = float(os.getenv('BDD_REQUEST_TIMEOUT', 10))
+
+# Maximum number of queries to the BDD in flight at the same time, to avoid hammering the API on large polls.
+MAX_CONCURRENT_REQUESTS = int(os.getenv('BDD_MAX_CONCURRENT_REQUESTS', 20))
+
+# Number of times a failed query (network error, timeout or server error) is retried, and delay (in seconds) before the
+# first retry, doubled at every retry.
+MAX_RETRIES = int(os.getenv('BDD_MAX_RETRIES', 2))
+RETRY_BACKOFF = float(os.getenv('BDD_RETRY_BACKOFF', 0.5))
+
+logger = logging.getLogger(__name__)
+
+# Blocking session, shared so that successive queries reuse the same keep-alive connection.
+_blocking_session = requests.Session()
+
+# Asynchronous session and its concurrency limit. Both are created lazily, since they must be created from within the
+# event loop they will be used in.
+_session = None
+_semaphore = None
+
+
 def query_bdd_for_player(url_query):
-    r = requests.get(url=url_query, params=None)
-    data = r.json()
-    return data
\ No newline at end of file
+    """
+    Blocking query of the BDD. Kept for tests and scripts, the bot should use query_bdd_for_player_async instead, which
+    does not freeze the event loop.
+
+    :param url_query: string
+    Url query with which to query the database
+    :return: the decoded json of the player
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = _blocking_session.get(url=url_query, params=None, timeout=REQUEST_TIMEOUT)
+            if r.status_code >= 500:
+                r.raise_for_status()
+            return r.json()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+            if attempt == MAX_RETRIES:
+                raise
+            logger.debug('Query %s failed, retrying', url_query, exc_info=True)
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+def _get_session():
+    """
+    Returns the asynchronous session shared by all queries, (re)creating it if needed.
+    """
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _session
+
+
+async def query_bdd_for_player_async(url_query):
+    """
+    Non blocking query of the BDD. Queries share a single keep-alive session, and at most MAX_CONCURRENT_REQUESTS of
+    them are in flight at the same time. A query taking more than REQUEST_TIMEOUT seconds is abandoned. Failed queries
+    (network errors, timeouts and server errors) are retried MAX_RETRIES times, after RETRY_BACKOFF seconds, then twice
+    as long at every retry, before their error (such as an asyncio.TimeoutError) is raised.
+
+    :param url_query: string
+    Url query with which to query the database
+    :return: the decoded json of the player
+    """
+    session = _get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _semaphore:
+                async with session.get(url_query) as r:
+                    if r.status >= 500:
+                        r.raise_for_status()
+                    # The API does not always set the json content type, so we do not check it.
+                    return await r.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            logger.debug('Query %s failed, retrying', url_query, exc_info=True)
+        # Other queries may use the connection while this one waits.
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+async def close_session():
+    """
+    Closes the asynchronous session, if any. Must be called before the event loop is closed.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -1,3 +1,8 @@
+import numpy as np
+
+WEEK = 7 * 24 * 3600 * 1000
+
+
 def query_bdd_for_player_mock(url_query):
     """
     This method is a mock for now.
@@ -19,3 +24,69 @@ def query_bdd_for_player_mock(url_query):
         json = [{ 'start': 2, 'end': 80000, 'repeatable': 1,'id': 'some-id'},
                 { 'start': 170000, 'end': 700000, 'repeatable': 1, 'id': 'some-id'}]
     return json
+
+
+async def query_bdd_for_player_async_mock(url_query):
+    """
+    Asynchronous counterpart of query_bdd_for_player_mock.
+    """
+    return query_bdd_for_player_mock(url_query)
+
+
+def generate_player_json(random_state, start_time, n_weeks, n_events, overlap_density=0.5, repeatable_ratio=0.0):
+    """
+    Generates a synthetic calendar, in the format returned by the BDD, to benchmark and test the scheduling pipeline.
+    The window [start_time, start_time + n_weeks weeks] is split into n_events slots of equal length, and every slot
+    holds one event of length overlap_density times the length of the slot, at a random offset within the slot. Events
+    are therefore sorted and do not overlap, and the higher overlap_density, the more calendars of several players
+    overlap.
+
+    :param random_state: np.random.RandomState used to draw events.
+    :param start_time: int, start of the window (unix timestamp in milliseconds).
+    :param n_weeks: int, length of the window in weeks.
+    :param n_events: int, number of events of the player.
+    :param overlap_density: float between 0 and 1, fraction of the window the player is available.
+    :param repeatable_ratio: float between 0 and 1, fraction of events flagged as repeatable.
+    :return: list of events (dicts with start, end, repeatable and id keys)
+    """
+    if n_events == 0:
+        return []
+    slot_length = max(int(n_weeks * WEEK) // n_events, 1)
+    event_length = max(int(slot_length * overlap_density), 1)
+    slot_starts = start_time + np.arange(n_events, dtype=np.int64) * slot_length
+    starts = slot_starts + random_state.randint(0, slot_length - event_length + 1, size=n_events)
+    repeatable = random_state.rand(n_events) < repeatable_ratio
+    return [{'start': int(start), 'end': int(start) + event_length, 'repeatable': int(is_repeatable),
+             'id': 'event-{}'.format(i)}
+            for i, (start, is_repeatable) in enumerate(zip(starts, repeatable))]
+
+
+class SyntheticBdd:
+    """
+    Offline stand-in for the BDD, serving synthetic calendars generated by generate_player_json. Its query methods
+    have the signature of those of bdd_handler, so that they can be used as side effects when patching it.
+    Calendars are generated once per player id, on the window of the first query about this player.
+    """
+    def __init__(self, n_events, overlap_density=0.5, repeatable_ratio=0.0, seed=0):
+        self.n_events = n_events
+        self.overlap_density = overlap_density
+        self.repeatable_ratio = repeatable_ratio
+        self.random_state = np.random.RandomState(seed)
+        self.calendars = {}
+        self.n_queries = 0
+
+    def get_calendar(self, player_id, start_time, end_time):
+        if player_id not in self.calendars:
+            n_weeks = max((end_time - start_time) / WEEK, 1 / WEEK)
+            self.calendars[player_id] = generate_player_json(self.random_state, start_time, n_weeks, self.n_events,
+                                                             self.overlap_density, self.repeatable_ratio)
+        return self.calendars[player_id]
+
+    def query_bdd_for_player(self, url_query):
+        self.n_queries += 1
+        path, query = url_query.split('?')
+        parameters = dict(parameter.split('=') for parameter in query.split('&'))
+        return self.get_calendar(path.split('/')[-1], int(parameters['from']), int(parameters['to']))
+
+    async def query_bdd_for_player_async(self, url_query):
+        return self.query_bdd_for_player(url_query)
@@ -0,0 +1,161 @@
+"""
+Local stand-in for the availability API (https://api.dispos.pocot.fr), serving the events of bdd_handler_mock (or of
+any other provider) over HTTP with a configurable latency. Point the bot to it through the BDD_URL environment variable.
+
+Running this module measures the speedup of concurrent fetching over serial blocking fetching:
+python bdd_server_mock.py [n_players] [latency_in_seconds]
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import bdd_handler
+import core
+from bdd_handler_mock import query_bdd_for_player_mock
+
+
+def mock_events_provider(player_id, start_time, end_time):
+    """
+    Default provider of events: the hard-coded players of bdd_handler_mock. As the BDD does, every occurrence of
+    repeatable events within [start_time, end_time] is returned.
+    """
+    events = query_bdd_for_player_mock('/events/' + player_id)
+    occurrences = [event for event in events if not event.get('repeatable')]
+    for event in events:
+        if event.get('repeatable'):
+            pattern = np.array([[event['start'], event['end']]], dtype=np.int64)
+            occurrences += [dict(event, start=start, end=end)
+                            for start, end in core.expand_repeatable_events(pattern, start_time, end_time).tolist()]
+    return sorted(occurrences, key=lambda event: event['start'])
+
+
+class MockBddServer:
+    """
+    HTTP server answering GET /events/<player_id>?from=<start_time>&to=<end_time> in a background thread.
+    Can be used as a context manager, url holds the root to pass as core.BDD_URL.
+    """
+    def __init__(self, latency=0.0, events_provider=mock_events_provider, port=0):
+        """
+        :param latency: float
+        Time (in seconds) the server waits before answering each request.
+        :param events_provider: callable
+        Called with the player id (as a string), start_time and end_time (as ints), returns the json of the player. If
+        it raises, the server answers with an error 500.
+        :param port: int
+        Port on which to listen. 0 picks a free port.
+        """
+        self.latency = latency
+        self.events_provider = events_provider
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections, so that pooled clients can be measured. Answers are written in one go, otherwise
+            # Nagle's algorithm and delayed acknowledgements add tens of milliseconds to every request.
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            wbufsize = -1
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                path = url.path.strip('/').split('/')
+                if len(path) != 2 or path[0] != 'events':
+                    self.send_error(404)
+                    return
+                query = parse_qs(url.query)
+                with server._lock:
+                    server.n_requests += 1
+                time.sleep(server.latency)
+                try:
+                    events = server.events_provider(path[1], int(query.get('from', [0])[0]),
+                                                    int(query.get('to', [0])[0]))
+                except Exception:
+                    # Providers raise to simulate failures of the API.
+                    self.send_error(500)
+                    return
+                body = json.dumps(events).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # The default backlog of 5 drops connections as soon as many clients connect at once.
+            request_queue_size = 1024
+
+        self._server = Server(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+async def _fetch_concurrently(player_ids):
+    try:
+        return await core.convert_players_json(player_ids, 0, 0, 1100000)
+    finally:
+        await bdd_handler.close_session()
+
+
+def measure_speedup(n_players, latency):
+    """
+    Fetches n_players calendars from a local stand-in, first serially with blocking queries, then concurrently.
+    :return: (serial_time, concurrent_time) in seconds
+    """
+    # Ids are made distinct (so that the cache does not answer for repeated players), but still contain the ids of
+    # bdd_handler_mock players, which is how the mock picks calendars.
+    known_ids = ['188626510901542912', '265523588918935552', '298673420181438465']
+    player_ids = [known_ids[i % 3] + str(i) for i in range(n_players)]
+    with MockBddServer(latency=latency) as server:
+        previous_url = core.BDD_URL
+        core.BDD_URL = server.url
+        try:
+            core.player_cache.clear()
+            start = time.perf_counter()
+            for player_id in player_ids:
+                core.convert_player_json(player_id, 0, 0, 1100000)
+            serial_time = time.perf_counter() - start
+
+            core.player_cache.clear()
+            start = time.perf_counter()
+            asyncio.run(_fetch_concurrently(player_ids))
+            concurrent_time = time.perf_counter() - start
+        finally:
+            core.BDD_URL = previous_url
+            core.player_cache.clear()
+    return serial_time, concurrent_time
+
+
+if __name__ == '__main__':
+    n_players = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    serial_time, concurrent_time = measure_speedup(n_players, latency)
+    print('{} players, {}s latency: serial {:.3f}s, concurrent {:.3f}s (speedup x{:.1f})'.format(
+        n_players, latency, serial_time, concurrent_time, serial_time / concurrent_time))
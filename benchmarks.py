@@ -0,0 +1,261 @@
+"""
+Benchmarks of the scheduling pipeline on synthetic calendars served by bdd_handler_mock, so that they run offline.
+
+Every stage of a poll is timed separately, for several numbers of players:
+- fetch: querying the (mocked) BDD for the events of every player, through the cache,
+- parse: converting the events of every player to an array of intervals,
+- intersect: finding all intervals where every player is available,
+- first_intersection: finding the first such interval with the sweep engine, which start_poll uses for the next
+  session of small groups without a group index,
+- grid_intersect: finding all such intervals with the grid engine, which start_poll uses for large groups instead,
+- group_index_build: building the index of the group (see group_index), as start_poll does for its first poll of a
+  group asking for several sessions,
+- group_index_update: updating the index of the group after every calendar changed (for instance once the cache
+  expired), as start_poll does for the next polls of the group,
+- poll: fetching, parsing and finding the next session with the engine chosen automatically, as start_poll does for
+  groups without an index,
+- group_poll: fetching and finding the next session from the index of the group, whose calendars did not change, as
+  start_poll does for groups with an index.
+
+Resolving the members of interest of a poll is timed on synthetic guilds, for several numbers of members (--guild-sizes):
+- member_index_build: indexing members of the guild by role, done once per guild,
+- member_resolution: resolving members holding any of the mentioned roles, as start_poll does.
+
+Results are printed (or written to --output) as JSON. When --baseline is given, the run fails (exit code 1) if the
+median time of a stage is slower than in the baseline by more than --tolerance (see find_regressions). --save-baseline
+stores the results as the new baseline.
+
+python benchmarks.py --sizes 3,30,300,1000,5000 --baseline benchmark_baseline.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import time
+from unittest import mock
+import numpy as np
+import core
+from types import SimpleNamespace
+from bdd_handler_mock import SyntheticBdd, WEEK
+from member_index import MemberIndex
+from group_index import GroupIndexCache, build_group_index, update_group_index
+
+# Start of the synthetic windows, a Monday at midnight (in milliseconds).
+START_TIME = 1600041600000
+
+
+def time_stage(function, n_repeats, setup=None):
+    """
+    Times function n_repeats times (calling setup, untimed, before each call). As with timeit, the garbage collector
+    is disabled during calls, so that timings do not depend on the objects left by previous stages.
+    :return: the minimum and median times, in seconds, and the result of the last call.
+    """
+    times = []
+    result = None
+    for _ in range(n_repeats):
+        if setup is not None:
+            setup()
+        result = None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2]}, result
+
+
+async def fetch_players_json(player_ids, start_time, end_time):
+    return await asyncio.gather(*[core.get_player_json_async(player_id, start_time, end_time)
+                                  for player_id in player_ids])
+
+
+async def run_poll(player_ids, start_time, end_time, minimum_length):
+    players_data = await core.convert_players_json(player_ids, start_time, start_time, end_time)
+    players_data = players_data.select(np.flatnonzero(players_data.valid))
+    return core.find_first_intersection(players_data, minimum_length, engine='auto')
+
+
+async def run_group_poll(group_indexes, player_ids, start_time, end_time, minimum_length):
+    players_json = await fetch_players_json(player_ids, start_time, end_time)
+    found = await group_indexes.get_intersections('group', player_ids, players_json, start_time, end_time, start_time)
+    return core.IntersectionSet(found).best(minimum_length)
+
+
+def run_benchmarks(sizes, n_events, n_weeks, overlap_density, repeatable_ratio, minimum_length, n_repeats, seed=0):
+    """
+    Runs every stage for every number of players in sizes.
+    :return: list of results, one dict per stage and size.
+    """
+    results = []
+    start_time = START_TIME
+    end_time = START_TIME + n_weeks * WEEK
+    parameters = {'events_per_player': n_events, 'window_weeks': n_weeks, 'overlap_density': overlap_density,
+                  'repeatable_ratio': repeatable_ratio}
+    for n_players in sizes:
+        bdd = SyntheticBdd(n_events, overlap_density, repeatable_ratio, seed=seed)
+        player_ids = [str(player_id) for player_id in range(n_players)]
+        for player_id in player_ids:
+            bdd.get_calendar(player_id, start_time, end_time)
+
+        def record(stage, timings):
+            results.append(dict(stage=stage, players=n_players, **parameters, **timings))
+
+        with mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=bdd.query_bdd_for_player_async):
+            timings, players_json = time_stage(
+                lambda: asyncio.run(fetch_players_json(player_ids, start_time, end_time)), n_repeats,
+                setup=core.player_cache.clear)
+            record('fetch', timings)
+
+            timings, players_data = time_stage(
+                lambda: core.parse_players_json(players_json, start_time, end_time), n_repeats)
+            record('parse', timings)
+
+            players_data = players_data.select(np.flatnonzero(players_data.valid))
+            timings, _ = time_stage(lambda: core.find_intersections(players_data, minimum_length), n_repeats)
+            record('intersect', timings)
+
+            timings, _ = time_stage(lambda: core.find_first_intersection(players_data, minimum_length), n_repeats)
+            record('first_intersection', timings)
+
+            timings, _ = time_stage(lambda: core.find_intersections_grid(players_data, minimum_length), n_repeats)
+            record('grid_intersect', timings)
+
+            timings, index = time_stage(
+                lambda: build_group_index(player_ids, players_json, start_time, end_time), n_repeats)
+            record('group_index_build', timings)
+
+            changed_bdd = SyntheticBdd(n_events, overlap_density, repeatable_ratio, seed=seed + 1)
+            changed_json = [changed_bdd.get_calendar(player_id, start_time, end_time) for player_id in player_ids]
+            timings, _ = time_stage(
+                lambda: update_group_index(index, player_ids, changed_json, start_time, end_time), n_repeats)
+            record('group_index_update', timings)
+
+            timings, _ = time_stage(
+                lambda: asyncio.run(run_poll(player_ids, start_time, end_time, minimum_length)), n_repeats,
+                setup=core.player_cache.clear)
+            record('poll', timings)
+
+            group_indexes = GroupIndexCache()
+            asyncio.run(run_group_poll(group_indexes, player_ids, start_time, end_time, minimum_length))
+            timings, _ = time_stage(
+                lambda: asyncio.run(run_group_poll(group_indexes, player_ids, start_time, end_time, minimum_length)),
+                n_repeats, setup=core.player_cache.clear)
+            record('group_poll', timings)
+        core.player_cache.clear()
+    return results
+
+
+def generate_guild(random_state, n_members, n_roles, roles_per_member, bot_ratio=0.01):
+    """
+    Generates a guild of n_members members (bot_ratio of which are bots) holding roles_per_member roles each, out of
+    n_roles.
+    """
+    guild = SimpleNamespace(id=0, members=[])
+    roles = [SimpleNamespace(id=role_id, guild=guild) for role_id in range(1, n_roles + 1)]
+    for member_id in range(1, n_members + 1):
+        member_roles = [roles[i] for i in random_state.choice(n_roles, size=roles_per_member, replace=False)]
+        guild.members.append(SimpleNamespace(id=member_id, roles=member_roles, bot=random_state.rand() < bot_ratio,
+                                             guild=guild))
+    return guild, roles
+
+
+def run_member_benchmarks(guild_sizes, n_roles, roles_per_member, n_mentioned_roles, n_repeats, seed=0):
+    """
+    Times the resolution of the members of a poll mentioning n_mentioned_roles roles, for every number of members in
+    guild_sizes.
+    :return: list of results, one dict per stage and size.
+    """
+    results = []
+    parameters = {'roles': n_roles, 'roles_per_member': roles_per_member, 'mentioned_roles': n_mentioned_roles}
+    random_state = np.random.RandomState(seed)
+    for n_members in guild_sizes:
+        guild, roles = generate_guild(random_state, n_members, n_roles, roles_per_member)
+        mentioned_roles = roles[:n_mentioned_roles]
+        index = MemberIndex()
+        # The previous index is dropped before timing, so that freeing it is not timed along with the next build.
+        timings, _ = time_stage(lambda: index.resolve(guild), n_repeats, setup=lambda: index.forget_guild(guild))
+        results.append(dict(stage='member_index_build', members=n_members, **parameters, **timings))
+        timings, _ = time_stage(lambda: index.resolve(guild, mentioned_roles), n_repeats)
+        results.append(dict(stage='member_resolution', members=n_members, **parameters, **timings))
+    return results
+
+
+def find_regressions(results, baseline, tolerance, noise_floor):
+    """
+    Compares results to baseline, matching them on stage and parameters. Median times are compared, as the minimum of
+    a few runs depends on how many of them happened to be unusually fast.
+    :return: list of messages, one per stage slower than its baseline by more than tolerance (a fraction) and by more
+    than noise_floor seconds (timings of the smallest sizes are too noisy to be compared relatively), or than the spread
+    of the baseline timings (median minus minimum), if larger.
+    """
+    def key(result):
+        return tuple(value for name, value in sorted(result.items()) if name not in ('min', 'median'))
+
+    baseline = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get(key(result))
+        if reference is None:
+            continue
+        slowdown = result['median'] - reference['median']
+        if slowdown > reference['median'] * tolerance \
+                and slowdown > max(noise_floor, reference['median'] - reference['min']):
+            size = '{} players'.format(result['players']) if 'players' in result else \
+                '{} members'.format(result['members'])
+            regressions.append('{} with {}: {:.4f}s, baseline {:.4f}s'.format(
+                result['stage'], size, result['median'], reference['median']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the scheduling pipeline on synthetic calendars.')
+    parser.add_argument('--sizes', default='3,30,300,1000,5000', help='comma separated numbers of players')
+    parser.add_argument('--events', type=int, default=20, help='events per player')
+    parser.add_argument('--weeks', type=int, default=1, help='window length in weeks')
+    parser.add_argument('--overlap-density', type=float, default=0.5, help='fraction of the window players are free')
+    parser.add_argument('--repeatable-ratio', type=float, default=0.0, help='fraction of repeatable events')
+    parser.add_argument('--minimum-length', type=int, default=3600 * 1000, help='minimum slot length (ms)')
+    parser.add_argument('--guild-sizes', default='1000,10000,50000', help='comma separated numbers of guild members')
+    parser.add_argument('--roles', type=int, default=50, help='roles per guild')
+    parser.add_argument('--roles-per-member', type=int, default=3, help='roles held by every member')
+    parser.add_argument('--mentioned-roles', type=int, default=3, help='roles mentioned by polls')
+    parser.add_argument('--repeats', type=int, default=9, help='number of runs of each stage')
+    parser.add_argument('--output', help='file to write results to (default: standard output)')
+    parser.add_argument('--baseline', help='baseline results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='tolerated slowdown, as a fraction')
+    parser.add_argument('--noise-floor', type=float, default=0.005, help='tolerated slowdown, in seconds')
+    parser.add_argument('--save-baseline', help='file to store results to as the new baseline')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks([int(size) for size in args.sizes.split(',')], args.events, args.weeks,
+                             args.overlap_density, args.repeatable_ratio, args.minimum_length, args.repeats)
+    results += run_member_benchmarks([int(size) for size in args.guild_sizes.split(',')], args.roles,
+                                     args.roles_per_member, args.mentioned_roles, args.repeats)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance, args.noise_floor)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
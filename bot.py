@@ -1,13 +1,73 @@
 import os
+import asyncio
+import logging
+from time import perf_counter
 from discord.ext import commands
 from dotenv import load_dotenv
 import core
+import bdd_handler
 import numpy as np
 import datetime
+from metrics import registry as metrics
+from single_flight import SingleFlight
+from member_index import MemberIndex
+from prefetch import PrefetchScheduler
+from group_index import GroupIndexCache
+import workers
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 
+# If set, metrics are written to this file (as JSON) after every poll.
+METRICS_FILE = os.getenv('METRICS_FILE')
+
+# Time (in seconds) after which a poll is cancelled, so that a pathological request cannot monopolise the bot.
+POLL_DEADLINE = float(os.getenv('POLL_DEADLINE', 60))
+
+# Time (in seconds) after which a poll gives up on calendars not fetched yet, and reports the members they belong to.
+FETCH_DEADLINE = float(os.getenv('FETCH_DEADLINE', 20))
+
+# Minimum time (in seconds) between two updates of the provisional result of a poll.
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', 2))
+
+# Maximum number of sessions per duration a poll can ask for (option -n).
+MAX_SESSIONS = 10
+
+# Polls running in every channel (channel id -> set of tasks), so that they can be cancelled.
+running_polls = {}
+
+# Computations of polls in flight, shared by identical polls.
+polls = SingleFlight()
+metrics.register_gauge('poll_coalescing', polls.stats)
+
+# Members of guilds by role, to resolve the members of interest of polls.
+member_index = MemberIndex()
+metrics.register_gauge('member_index', member_index.stats)
+
+# Prefetching of calendars of members ahead of the polls they are expected in. It waits while polls are running.
+prefetcher = PrefetchScheduler(busy=lambda: any(running_polls.values()))
+metrics.register_gauge('prefetch', prefetcher.stats)
+
+# Intersections of the groups polled most recently, updated incrementally from one poll to the next.
+group_indexes = GroupIndexCache()
+metrics.register_gauge('group_index', group_indexes.stats)
+
+# Callbacks showing progress of polls, for all polls sharing a computation (poll key -> set of coroutine functions).
+poll_listeners = {}
+
+logger = logging.getLogger(__name__)
+
+
+async def notify_poll_listeners(poll_key, progress):
+    """
+    Shows progress of a poll to all polls waiting for it. Failures (for instance to edit a message) are only logged.
+    """
+    listeners = list(poll_listeners.get(poll_key, ()))
+    results = await asyncio.gather(*[listener(progress) for listener in listeners], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning('Could not show progress of a poll: %s', result)
+
 
 class CustomBot(commands.Bot):
     def __init__(self):
@@ -18,7 +78,10 @@ class CustomBot(commands.Bot):
         super(CustomBot, self).__init__(command_prefix=self.cmd_prefix)
         self.help_command = commands.DefaultHelpCommand(width=80000)
         self.add_command(self.start_poll)
-        print(self.commands)
+        self.add_command(self.cancel_polls)
+        self.add_command(self.display_metrics)
+        self.prefetch_task = None
+        logger.debug('Commands: %s', self.commands)
 
     async def on_ready(self):
         """
@@ -27,33 +90,50 @@ class CustomBot(commands.Bot):
         :return:
         """
 
-        print(f'{self.user} has connected to Discord!')
+        logger.info('%s has connected to Discord!', self.user)
 
         for guild in self.guilds:
-            print(
-                f'{self.user} is connected to the following guild:\n'
-                f'{guild.name}(id: {guild.id})'
-            )
+            logger.info('%s is connected to the following guild: %s(id: %s)', self.user, guild.name, guild.id)
+
+        # on_ready is called again after reconnections.
+        if prefetcher.budget > 0 and self.prefetch_task is None:
+            self.prefetch_task = asyncio.ensure_future(prefetcher.run())
+
+    async def close(self):
+        """
+        Closes the connection to Discord, the session used to query the BDD, the worker pool and the snapshot store.
+        """
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+        await bdd_handler.close_session()
+        workers.shutdown_executor()
+        if core.snapshot_store is not None:
+            await core.flush_snapshots()
+            core.snapshot_store.close()
+        await super(CustomBot, self).close()
 
     async def display_unknown(self, message, args=None):
         await message.channel.send('Unknown command!')
 
+    # The index of members by role is kept up to date from the events of Discord.
+    async def on_member_join(self, member):
+        member_index.add_member(member)
 
-    @staticmethod
-    def filter_members_with_role_or_mention(ctx, members, roles, mentions):
-        filteredMembers= []
-        filteredMembers.extend(mentions)
+    async def on_member_remove(self, member):
+        member_index.remove_member(member)
+
+    async def on_member_update(self, before, after):
+        member_index.update_member(before, after)
+
+    async def on_guild_role_delete(self, role):
+        member_index.remove_role(role)
 
-        filteredRoleMembers = []
-        if len(roles) != 0:
-            for role in roles:
-                roleMembers = list(filter(lambda member: role in member.roles, members))
-                if len(roleMembers) != 0:
-                    filteredRoleMembers.extend(roleMembers)
+    async def on_guild_available(self, guild):
+        # Events may have been missed while the guild was unavailable.
+        member_index.forget_guild(guild)
 
-        filteredMembers.extend(filteredRoleMembers)
-        filteredMembers = set(filteredMembers)
-        return filteredMembers
+    async def on_guild_remove(self, guild):
+        member_index.forget_guild(guild)
 
     @commands.command(name='startpoll', help='polls every member of the channel for availability. Syntax is -startpoll '
                                              '@members_of_interest , where members_of_interest can be a group of users,'
@@ -64,10 +144,18 @@ class CustomBot(commands.Bot):
                                              '-startpoll @members_of_interest -t HH:MM. By default, the bot looks at '
                                              'calendars for one week, starting from the day the query is issued. It is'
                                              'possible to ask for more weeks, through the option -w n_weeks .'
-                                             'Complete syntax is -startpoll @members_of_interest -t HH:MM -w n_weeks')
+                                             ' To find sessions where only some members are available, use the '
+                                             'option -q n_members, or -q percentage% (of members who filled their '
+                                             'availabilities). '
+                                             'Several durations can be asked for at once, with -t HH:MM,HH:MM,... or '
+                                             'a range -t HH:MM-HH:MM (by steps of 30 minutes, or -t HH:MM-HH:MM/HH:MM)'
+                                             ', and several sessions per duration with -n n_sessions, the earliest '
+                                             'ones, or the longest ones with -r longest. '
+                                             'Complete syntax is -startpoll @members_of_interest -t HH:MM -w n_weeks '
+                                             '-q n_members -n n_sessions -r longest')
     async def start_poll(self, *, args=None):
         # This is the time for two hours in seconds
-        minimum_length = 7200 * 1000
+        minimum_lengths = [7200 * 1000]
 
         # At minimum, bot will consider one week starting from today for availabilities.
         n_weeks = 1
@@ -77,9 +165,7 @@ class CustomBot(commands.Bot):
         mentions = ctx.message.mentions
         mentions_everyone = ctx.message.mention_everyone
         roles = ctx.message.role_mentions
-        print(mentions)
-        print(mentions_everyone)
-        print(roles)
+        logger.debug('Mentions: %s, mentions everyone: %s, roles: %s', mentions, mentions_everyone, roles)
 
         # Check whether we had a time option specified and if so, retrieve its corresponding value
         full_query = ctx.message.content.split(' ')
@@ -88,9 +174,11 @@ class CustomBot(commands.Bot):
             if full_query.index('-t') < len(full_query) - 1:
                 time_req = full_query[full_query.index('-t')+1]
                 try:
-                    minimum_length = core.convert_time_string_to_unix_timestamp(time_req)*1000
+                    minimum_lengths = core.convert_durations_string_to_lengths(time_req)
                 except ValueError:
-                    await self.send('Invalid format. Should conform to HH:MM, where HH and MM are both non negative.')
+                    await self.send('Invalid format. Should conform to HH:MM, where HH and MM are both non negative, '
+                                    'to HH:MM,HH:MM,... for several durations, or to HH:MM-HH:MM[/HH:MM] for a range '
+                                    'of durations.')
                     return
             else:
                 await self.send('-t option expected an argument. Start over, idiot.')
@@ -113,84 +201,370 @@ class CustomBot(commands.Bot):
                     n_weeks = weeks_req
             else:
                 await self.send('-w option expected an argument afterwards. Start over, idiot.')
+
+        quorum_req = None
+        if '-q' in full_query:
+            if full_query.index('-q') < len(full_query)-1:
+                quorum_req = full_query[full_query.index('-q')+1]
+                try:
+                    core.convert_quorum_string_to_count(quorum_req, 1)
+                except ValueError:
+                    await self.send('Option -q expected a strictly positive integer or a percentage, but received {} '
+                                    'instead. Try over.'.format(quorum_req))
+                    return
+            else:
+                await self.send('-q option expected an argument afterwards. Start over, idiot.')
+                return
+
+        n_sessions = 1
+        if '-n' in full_query:
+            if full_query.index('-n') < len(full_query)-1:
+                sessions_req = full_query[full_query.index('-n')+1]
+                try:
+                    n_sessions = int(sessions_req)
+                except ValueError:
+                    n_sessions = 0
+                if n_sessions <= 0 or n_sessions > MAX_SESSIONS:
+                    await self.send('Option -n expected an integer between 1 and {}, but received {} instead. Try '
+                                    'over.'.format(MAX_SESSIONS, sessions_req))
+                    return
+            else:
+                await self.send('-n option expected an argument afterwards. Start over, idiot.')
+                return
+
+        longest = False
+        if '-r' in full_query:
+            ranking_req = full_query[full_query.index('-r')+1] if full_query.index('-r') < len(full_query)-1 else None
+            if ranking_req not in ('longest', 'earliest'):
+                await self.send('Option -r expected longest or earliest, but received {} instead. Try '
+                                'over.'.format(ranking_req))
+                return
+            longest = ranking_req == 'longest'
+
+        poll = asyncio.ensure_future(CustomBot.run_poll(ctx, mentions, mentions_everyone, roles, minimum_lengths,
+                                                        n_weeks, quorum_req, n_sessions, longest))
+        channel_polls = running_polls.setdefault(ctx.message.channel.id, set())
+        channel_polls.add(poll)
+        try:
+            done, _ = await asyncio.wait({poll}, timeout=POLL_DEADLINE)
+            if not done:
+                poll.cancel()
+                metrics.increment('polls_timed_out')
+                await ctx.send('Poll took more than {} seconds and was cancelled. Try over with fewer members or '
+                               'weeks.'.format(POLL_DEADLINE))
+            elif poll.cancelled():
+                metrics.increment('polls_cancelled')
+                await ctx.send('Poll cancelled.')
+            else:
+                # Raises errors of the poll, if any.
+                poll.result()
+        finally:
+            channel_polls.discard(poll)
+            if not poll.done():
+                poll.cancel()
+
+    @staticmethod
+    def format_duration(length):
+        """
+        Formats a duration, in milliseconds, as hours and minutes.
+        """
+        interval = length/1000
+        days = np.floor(interval/(3600*24))
+        hours = np.floor((interval-days*3600*24)/3600)
+        minutes = np.floor((interval - days*3600*24 - hours * 3600)/60)
+
+        hour_strings = ""
+        if hours == 1:
+            hour_strings = str(hours) + " hour "
+        if hours > 1:
+            hour_strings = str(hours) + " hours "
+
+        minute_strings = ""
+
+        if minutes == 1:
+            minute_strings = str(minutes) + " minute "
+        if minutes > 1 :
+            minute_strings = str(minutes) + " minutes "
+
+        inter_str = ""
+        if hour_strings != "" and minute_strings != "":
+            inter_str = "and "
+        return hour_strings + inter_str + minute_strings
+
+    @staticmethod
+    def format_session(session):
+        """
+        Formats the day and hours of a session.
+        """
+        time = core.convert_timestamp_to_date(session[0], french_time=True)
+        time_end = core.convert_timestamp_to_date(session[1], french_time=True).strftime('%H:%M')
+        return core.convert_number_to_day_string(time.weekday()) + " the " + str(time.day) + " of " + \
+            core.convert_number_to_month_string(time.month) + " from " + time.strftime('%H:%M') + " to " + time_end
+
+    @staticmethod
+    def format_progress(progress, minimum_lengths):
+        """
+        Formats a provisional result of a poll (see compute_poll).
+        """
+        n_fetched = progress['n_data_members'] + len(progress['missing_ids'])
+        message = '{}/{} calendars fetched so far'.format(n_fetched, n_fetched + progress['n_pending'])
+        sessions = progress['sessions'][minimum_lengths[0]]
+        if len(sessions) == 0:
+            return message + ', no session found yet.'
+        return message + ', provisional next session (lasting at least ' + \
+            CustomBot.format_duration(minimum_lengths[0]) + '): **' + CustomBot.format_session(sessions[0][0]) + '**'
+
+    @staticmethod
+    async def run_poll(ctx, mentions, mentions_everyone, roles, minimum_lengths, n_weeks, quorum_req, n_sessions=1,
+                       longest=False):
+        """
+        Looks for the next session of members of interest and reports it. Parameters are those parsed by start_poll.
+        With several minimum lengths, or several sessions per minimum length, sessions of every minimum length are
+        reported together.
+        """
+        poll_start = perf_counter()
+
+        progress_message = await ctx.send('Poll started.')
+        progress_shown = False
+
+        async def show_progress(progress):
+            nonlocal progress_shown
+            progress_shown = True
+            await progress_message.edit(content='Poll started. ' + CustomBot.format_progress(progress, minimum_lengths))
+
+        with metrics.timer('member_resolution'):
+            member_ids = list(member_index.resolve(ctx.message.guild, roles, mentions, everyone=mentions_everyone))
+        prefetcher.record(member_ids, n_weeks)
+
+        # Identical polls in flight (for instance issued by several users of a guild at once) share their result.
+        # Their progress is shown to all of them.
+        poll_key = (frozenset(member_ids), tuple(minimum_lengths), n_weeks, quorum_req, n_sessions, longest)
+        group_key = (ctx.message.guild.id, frozenset(role.id for role in roles),
+                     frozenset(member.id for member in mentions), mentions_everyone, n_weeks)
+        listeners = poll_listeners.setdefault(poll_key, set())
+        listeners.add(show_progress)
+        try:
+            result = await polls.run(poll_key, lambda: CustomBot.compute_poll(
+                member_ids, minimum_lengths, n_weeks, quorum_req, n_sessions, longest, group_key=group_key,
+                on_progress=lambda progress: notify_poll_listeners(poll_key, progress)))
+        finally:
+            listeners.discard(show_progress)
+            if len(listeners) == 0:
+                del poll_listeners[poll_key]
+        quorum = result['quorum']
+        weeks_string = str(n_weeks) + " week" + ('s' if n_weeks > 1 else '')
+
+        with metrics.timer('render'):
+            if progress_shown:
+                await progress_message.edit(content='Poll started. {}/{} calendars fetched.'.format(
+                    len(member_ids) - len(result['unreachable_ids']), len(member_ids)))
+            if result['n_data_members'] == 0 and len(result['unreachable_ids']) != 0:
+                await ctx.send("Couldn't find a date: no availabilities could be fetched in time.")
+            elif result['n_data_members'] == 0:
+                await ctx.send("No one filled their availabilities! Couldn't find a date, please fill your availabilities.")
+            elif quorum is not None and quorum > result['n_data_members']:
+                await ctx.send("Only {} members filled their availabilities, a quorum of {} can't be reached.".format(
+                    result['n_data_members'], quorum))
+            elif len(minimum_lengths) == 1 and n_sessions == 1:
+                sessions = result['sessions'][minimum_lengths[0]]
+                if len(sessions) == 0:
+                    await ctx.send("Based on members availability, a game can't be scheduled in the next " +
+                                   weeks_string)
+                else:
+                    next_session, absent_ids = sessions[0]
+                    logger.debug('Next session: %s - %s', next_session[0], next_session[1])
+                    await ctx.send("Based on members availability, next session (lasting at least " +
+                                   CustomBot.format_duration(next_session[1] - next_session[0]) + ") would be **" +
+                                   CustomBot.format_session(next_session) + "**")
+
+                    if len(absent_ids) != 0:
+                        absent_members_string = ""
+                        for member_id in absent_ids:
+                            absent_members_string += " <@{}>, ".format(member_id)
+                        absent_members_string += "would not be available for this session."
+                        await ctx.send(absent_members_string)
+            else:
+                for minimum_length in minimum_lengths:
+                    sessions = result['sessions'][minimum_length]
+                    if len(sessions) == 0:
+                        await ctx.send("Based on members availability, no session lasting at least " +
+                                       CustomBot.format_duration(minimum_length) + "can be scheduled in the next " +
+                                       weeks_string)
+                        continue
+                    lines = ["Based on members availability, sessions lasting at least " +
+                             CustomBot.format_duration(minimum_length) + "would be:"]
+                    for session, absent_ids in sessions:
+                        line = "- **" + CustomBot.format_session(session) + "**"
+                        if len(absent_ids) != 0:
+                            line += ", without " + ", ".join("<@{}>".format(member_id) for member_id in absent_ids)
+                        lines.append(line)
+                    await ctx.send("\n".join(lines))
+
+            missing_members_string = ""
+            for member_id in result['missing_ids']:
+                missing_members_string += " <@{}>, ".format(member_id)
+
+            if missing_members_string != "":
+                missing_members_string += "did not fill availabilities. Please go fill it at: https://dispos.pocot.fr/."
+                await ctx.send(missing_members_string)
+
+            if len(result['unreachable_ids']) != 0:
+                await ctx.send(", ".join("<@{}>".format(member_id) for member_id in result['unreachable_ids']) +
+                               " could not be reached in time: their availabilities were not taken into account.")
+
+        metrics.observe('poll', perf_counter() - poll_start)
+        if METRICS_FILE:
+            metrics.write(METRICS_FILE)
+
+    @staticmethod
+    async def compute_poll(member_ids, minimum_lengths, n_weeks, quorum_req, n_sessions=1, longest=False,
+                           group_key=None, on_progress=None):
+        """
+        Fetches calendars of members and looks for their next sessions. Calendars are fetched and intersected once for
+        all minimum lengths (see core.find_best_intersections). Members whose calendar could not be fetched within
+        FETCH_DEADLINE seconds are left out.
+        :param on_progress: coroutine function, called while calendars are being fetched (at most every
+        PROGRESS_INTERVAL seconds) with a provisional result, computed from the calendars fetched so far. It also holds
+        the number of members whose calendar is still being fetched (n_pending).
+        :param group_key: key of the group of members polled (see group_index.GroupIndexCache). Without a quorum, the
+        intersection of their calendars is then updated from that of the previous poll of the group, rather than
+        computed again. Polls for the next session only use the index of the group only if it already exists.
+        :return: dict with the sessions found for every minimum length (at most n_sessions (session, absent_ids), where
+        absent_ids are ids of members who would be absent from the session, with a quorum), the quorum (None if all
+        members must be available), ids of members who did not fill their availabilities, ids of members whose
+        calendar could not be fetched, and the number of members who filled their availabilities.
+        """
         td = datetime.datetime.utcnow()
         from_optimistic, to_optimistic = core.get_from_and_to_optimistic(td, n_weeks=n_weeks)
         from_strict = core.get_from_strict(td)
-        print('{} - {}'.format(from_strict, to_optimistic))
-
-        await self.send('Poll started.')
-
-        members_of_interest = []
-        if mentions_everyone:
-            for member in ctx.message.guild.members:
-                members_of_interest.append(member)
-        else:
-            members_of_interest = CustomBot.filter_members_with_role_or_mention(ctx, ctx.message.guild.members,
-                                                                                roles, mentions)
-
-        overall_data = []
-        missing_data_members = []
-        for member in members_of_interest:
-            member_data = core.convert_player_json(player_id=member.id, start_time=from_optimistic,
-                                                   start_time_strict=from_strict,
-                                                   end_time=to_optimistic)
-            if member_data is None:
-                missing_data_members.append(member)
-            else:
-                overall_data.append(member_data)
-        if len(missing_data_members) == len(members_of_interest):
-            await self.send("No one filled their availabilities! Couldn't find a date, please fill your availabilities.")
-        else:
-            intersections = core.find_intersections(overall_data, minimum_length=minimum_length)
-
-            if len(intersections) == 0:
-                msg= "Based on members availability, a game can't be scheduled in the next "+str(n_weeks) + " week"
-                if n_weeks > 1:
-                    msg += 's'
-                await self.send(msg)
-            else:
-                next_session = intersections[0]
-                print('Next_session: {}'.format(next_session[0]))
-                print('Next_session end: {}'.format(next_session[1]))
-                interval = (next_session[1]-next_session[0])/1000
-                days = np.floor(interval/(3600*24))
-                hours = np.floor((interval-days*3600*24)/3600)
-                minutes = np.floor((interval - days*3600*24 - hours * 3600)/60)
-
-                time = core.convert_timestamp_to_date(next_session[0], french_time=True)
-                time_rep = time.strftime('%H:%M')
-                time_end = core.convert_timestamp_to_date(next_session[1], french_time=True).strftime('%H:%M')
-
-                hour_strings = ""
-                if hours == 1:
-                    hour_strings = str(hours) + " hour "
-                if hours > 1:
-                    hour_strings = str(hours) + " hours "
-
-                minute_strings = ""
-
-                if minutes == 1:
-                    minute_strings = str(minutes) + " minute "
-                if minutes > 1 :
-                    minute_strings = str(minutes) + " minutes "
-
-                inter_str = ""
-                if hour_strings != "" and minute_strings != "":
-                    inter_str = "and "
-
-                await self.send("Based on members availability, next session (lasting at least " + hour_strings +
-                                inter_str + minute_strings + ") would be **" +
-                                core.convert_number_to_day_string(time.weekday()) + " the " + str(time.day) + " of " +
-                                core.convert_number_to_month_string(time.month) + " from " + time.strftime('%H:%M') +
-                                " to " + time_end + "**")
-
-        missing_members_string = ""
-        for member in missing_data_members:
-            missing_members_string += " <@{}>, ".format(member.id)
-
-        if missing_members_string != "":
-            missing_members_string += "did not fill availabilities. Please go fill it at: https://dispos.pocot.fr/."
-            await self.send(missing_members_string)
+        logger.debug('Poll window: %s - %s', from_strict, to_optimistic)
+        last_progress = perf_counter()
+
+        async def report_progress(players_json):
+            nonlocal last_progress
+            if perf_counter() - last_progress < PROGRESS_INTERVAL:
+                return
+            fetched = [i for i, player_json in enumerate(players_json) if player_json is not None]
+            progress = await CustomBot.find_sessions([member_ids[i] for i in fetched],
+                                                     [players_json[i] for i in fetched], [], from_strict,
+                                                     to_optimistic, minimum_lengths, quorum_req, n_sessions, longest)
+            progress['n_pending'] = len(member_ids) - len(fetched)
+            await on_progress(progress)
+            last_progress = perf_counter()
+
+        with metrics.timer('fetch'):
+            players_json, failed_indices = await core.fetch_players_json(
+                member_ids, from_optimistic, to_optimistic, timeout=FETCH_DEADLINE,
+                on_progress=report_progress if on_progress is not None else None)
+        failed_indices = set(failed_indices)
+        fetched = [i for i in range(len(member_ids)) if i not in failed_indices]
+        fetched_ids = [member_ids[i] for i in fetched]
+        fetched_json = [players_json[i] for i in fetched]
+        unreachable_ids = [member_ids[i] for i in sorted(failed_indices)]
+        # The next session only is found faster from the calendars (see find_sessions) than by building an index, so
+        # it is answered from the index of the group only if the group already has one.
+        single_session = len(minimum_lengths) == 1 and n_sessions == 1 and not longest
+        if group_key is not None and quorum_req is None and group_indexes.max_groups > 0 and \
+                (not single_session or group_indexes.has_index(group_key, from_optimistic, to_optimistic)):
+            return await CustomBot.find_group_sessions(group_key, fetched_ids, fetched_json, unreachable_ids,
+                                                       from_optimistic, from_strict, to_optimistic, minimum_lengths,
+                                                       n_sessions, longest)
+        return await CustomBot.find_sessions(fetched_ids, fetched_json, unreachable_ids, from_strict, to_optimistic,
+                                             minimum_lengths, quorum_req, n_sessions, longest)
+
+    @staticmethod
+    async def find_sessions(member_ids, members_json, unreachable_ids, start_time_strict, end_time, minimum_lengths,
+                            quorum_req, n_sessions, longest):
+        """
+        Looks for the next sessions of members, given their calendars. See compute_poll.
+        """
+        n_events = sum(len(member_json) for member_json in members_json)
+        with metrics.timer('parse'):
+            members_data = await workers.run_cpu_bound(n_events, core.parse_players_json, members_json,
+                                                       start_time_strict, end_time)
+        data_member_ids = [member_id for member_id, valid in zip(member_ids, members_data.valid) if valid]
+        missing_ids = [member_id for member_id, valid in zip(member_ids, members_data.valid) if not valid]
+        overall_data = members_data.select(np.flatnonzero(members_data.valid))
+        quorum = None
+        if quorum_req is not None and len(data_member_ids) != 0:
+            quorum = core.convert_quorum_string_to_count(quorum_req, len(data_member_ids))
+        sessions = {minimum_length: [] for minimum_length in minimum_lengths}
+        if len(data_member_ids) != 0 and (quorum is None or quorum <= len(data_member_ids)):
+            n_intervals = overall_data.n_intervals
+            with metrics.timer('intersect'):
+                if len(minimum_lengths) == 1 and n_sessions == 1 and not longest:
+                    # The next session only: calendars are looked at until it is found.
+                    if quorum is None:
+                        next_session = await workers.run_cpu_bound(n_intervals, core.find_first_intersection,
+                                                                   overall_data, minimum_length=minimum_lengths[0],
+                                                                   engine='auto')
+                        absent_indices = []
+                    else:
+                        next_session, absent_indices = await workers.run_cpu_bound(
+                            n_intervals, core.find_first_quorum_intersection, overall_data,
+                            minimum_length=minimum_lengths[0], quorum=quorum)
+                    if next_session is not None:
+                        sessions[minimum_lengths[0]] = [(next_session, absent_indices)]
+                else:
+                    sessions = await workers.run_cpu_bound(n_intervals, core.find_best_intersections, overall_data,
+                                                           minimum_lengths, k=n_sessions, longest=longest,
+                                                           quorum=quorum, engine='auto')
+            sessions = {minimum_length: [(session, [data_member_ids[i] for i in absent_indices])
+                                         for session, absent_indices in found_sessions]
+                        for minimum_length, found_sessions in sessions.items()}
+        return {'sessions': sessions, 'quorum': quorum, 'missing_ids': missing_ids, 'unreachable_ids': unreachable_ids,
+                'n_data_members': len(data_member_ids)}
+
+    @staticmethod
+    async def find_group_sessions(group_key, member_ids, members_json, unreachable_ids, start_time, start_time_strict,
+                                  end_time, minimum_lengths, n_sessions, longest):
+        """
+        Looks for the next sessions of members who must all be available, from the index of their group: only
+        calendars which changed since the previous poll of the group are parsed and intersected again. Calendars are
+        indexed from start_time (the start of the day, see core.get_from_and_to_optimistic), so that the index holds
+        from one poll of the day to the next, and intersections are clipped to start_time_strict. See compute_poll.
+        """
+        data_member_ids = [member_id for member_id, member_json in zip(member_ids, members_json) if len(member_json)]
+        missing_ids = [member_id for member_id, member_json in zip(member_ids, members_json) if not len(member_json)]
+        sessions = {minimum_length: [] for minimum_length in minimum_lengths}
+        if len(data_member_ids) != 0:
+            with metrics.timer('intersect'):
+                found = await group_indexes.get_intersections(group_key, member_ids, members_json, start_time,
+                                                              end_time, start_time_strict)
+                intersections = core.IntersectionSet(found)
+                sessions = {minimum_length: intersections.best(minimum_length, n_sessions, longest)
+                            for minimum_length in minimum_lengths}
+        return {'sessions': sessions, 'quorum': None, 'missing_ids': missing_ids, 'unreachable_ids': unreachable_ids,
+                'n_data_members': len(data_member_ids)}
+
+    @commands.command(name='cancelpoll', help='cancels polls running in the channel')
+    async def cancel_polls(self, args=None):
+        """
+        Cancels polls running in the channel the command is issued in.
+        """
+        ctx = self
+        channel_polls = running_polls.get(ctx.message.channel.id, set())
+        for poll in channel_polls:
+            poll.cancel()
+        if len(channel_polls) == 0:
+            await ctx.send('No poll running in this channel.')
+
+    @commands.command(name='metrics', help='shows metrics of the bot (administrators only)')
+    @commands.has_permissions(administrator=True)
+    async def display_metrics(self, args=None):
+        """
+        Admin command. Displays the number of polls, the duration of their stages, counters and statistics of the
+        cache.
+        """
+        ctx = self
+        snapshot = metrics.snapshot()
+        lines = []
+        for stage, histogram in snapshot.pop('stages').items():
+            lines.append('{}: {} calls, mean {:.4f}s, max {:.4f}s'.format(stage, histogram['count'], histogram['mean'],
+                                                                       histogram['max']))
+        for name, values in snapshot.items():
+            lines.append('{}: {}'.format(name, ', '.join('{}={}'.format(key, value) for key, value in values.items())))
+        await ctx.send('```\n' + '\n'.join(lines) + '\n```')
 
 
     @commands.command(name='help', help='shows help (duh)')
@@ -205,5 +579,7 @@ class CustomBot(commands.Bot):
         self.help_command.send_bot_help()
 
 
-client = CustomBot()
-client.run(TOKEN)
+if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    client = CustomBot()
+    client.run(TOKEN)
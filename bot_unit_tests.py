@@ -0,0 +1,240 @@
+import asyncio
+import datetime
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import bdd_handler
+import core
+from bot import CustomBot
+import bot
+from bdd_server_mock import MockBddServer, mock_events_provider
+from member_index import MemberIndex
+from group_index import GroupIndexCache
+import load_test
+
+PLAYER_IDS = [188626510901542912, 265523588918935552, 298673420181438465]
+
+
+class FakeMember:
+    def __init__(self, member_id, roles=(), bot=False, guild=None):
+        self.id = member_id
+        self.roles = list(roles)
+        self.bot = bot
+        self.guild = guild
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.edits = []
+
+    async def edit(self, content):
+        self.content = content
+        self.edits.append(content)
+
+
+def make_context(members, mentions):
+    """
+    Minimal stand-in for a discord.py context, recording messages sent.
+    """
+    async def send(message):
+        ctx.sent.append(message)
+        ctx.messages.append(FakeMessage(message))
+        return ctx.messages[-1]
+
+    guild = SimpleNamespace(id=0, members=members)
+    message = SimpleNamespace(guild=guild, channel=SimpleNamespace(id=1), mentions=mentions, mention_everyone=False,
+                              role_mentions=[], content='-startpoll')
+    ctx = SimpleNamespace(message=message, send=send, sent=[], messages=[])
+    return ctx
+
+
+class RunPollTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        core.player_cache.clear()
+
+    async def asyncTearDown(self):
+        await bdd_handler.close_session()
+
+    async def test_concurrent_identical_polls_are_coalesced(self):
+        members = [FakeMember(player_id) for player_id in PLAYER_IDS]
+        contexts = [make_context(members, members) for _ in range(5)]
+        coalesced = bot.polls.coalesced
+        with MockBddServer(latency=0.1) as server:
+            with mock.patch('core.BDD_URL', server.url):
+                await asyncio.gather(*[CustomBot.run_poll(ctx, members, False, [], [4], 1, None) for ctx in contexts])
+            self.assertEqual(server.n_requests, len(PLAYER_IDS))
+        self.assertEqual(bot.polls.coalesced - coalesced, 4)
+        for ctx in contexts:
+            self.assertEqual(ctx.sent, contexts[0].sent)
+
+    async def test_cancelling_all_polls_sharing_a_computation_cancels_it(self):
+        members = [FakeMember(player_id) for player_id in PLAYER_IDS]
+        contexts = [make_context(members, members) for _ in range(2)]
+        with MockBddServer(latency=0.2) as server:
+            with mock.patch('core.BDD_URL', server.url), \
+                    mock.patch('bot.CustomBot.find_sessions', wraps=CustomBot.find_sessions) as find_sessions:
+                first, second = [asyncio.ensure_future(CustomBot.run_poll(ctx, members, False, [], [4], 1, None))
+                                 for ctx in contexts]
+                await asyncio.sleep(0.05)
+                # The other poll still waits for the computation.
+                first.cancel()
+                await asyncio.sleep(0.05)
+                self.assertEqual(bot.polls.stats()['in_flight'], 1)
+                second.cancel()
+                await asyncio.sleep(0.3)
+                self.assertEqual(bot.polls.stats()['in_flight'], 0)
+                self.assertEqual(find_sessions.call_count, 0)
+                with self.assertRaises(asyncio.CancelledError):
+                    await second
+
+    async def test_fetch_stage_is_timed_once_per_poll(self):
+        def count(stage):
+            histogram = bot.metrics.snapshot()['stages'].get(stage)
+            return histogram['count'] if histogram is not None else 0
+
+        fetches, requests = count('fetch'), count('api_request')
+        with MockBddServer(latency=0.01) as server:
+            with mock.patch('core.BDD_URL', server.url):
+                await CustomBot.compute_poll(PLAYER_IDS, [4], 1, None)
+        self.assertEqual(count('fetch') - fetches, 1)
+        self.assertEqual(count('api_request') - requests, len(PLAYER_IDS))
+
+    async def test_concurrent_fetches_are_coalesced(self):
+        with MockBddServer(latency=0.1) as server:
+            with mock.patch('core.BDD_URL', server.url):
+                players_data = await asyncio.gather(*[core.convert_players_json(PLAYER_IDS, 0, 0, 1100000)
+                                                      for _ in range(10)])
+            self.assertEqual(server.n_requests, len(PLAYER_IDS))
+        for player_data in players_data:
+            self.assertEqual([data.tolist() for data in player_data], [data.tolist() for data in players_data[0]])
+
+    async def test_several_durations_in_one_poll(self):
+        members = [FakeMember(player_id) for player_id in PLAYER_IDS[:2]]
+        ctx = make_context(members, members)
+        now = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+        minimum_lengths = [100000, 50000, 10000]
+        with MockBddServer(latency=0.01) as server:
+            with mock.patch('core.BDD_URL', server.url), mock.patch('bot.datetime') as bot_datetime:
+                bot_datetime.datetime.utcnow.return_value = now
+                result = await CustomBot.compute_poll(PLAYER_IDS[:2], minimum_lengths, 1, None, n_sessions=2)
+                await CustomBot.run_poll(ctx, members, False, [], minimum_lengths, 1, None, 2)
+                start_time, end_time = core.get_from_and_to_optimistic(now, 1)
+                players_data = await core.convert_players_json(PLAYER_IDS[:2], start_time, 0, end_time)
+            self.assertEqual(server.n_requests, 2)
+        for minimum_length in minimum_lengths:
+            expected = core.find_top_intersections(players_data, minimum_length, 2, longest=False)
+            self.assertEqual(result['sessions'][minimum_length], [(session, []) for session in expected])
+        self.assertEqual(result['sessions'][100000][0][0], [200000, 310000])
+        self.assertEqual(len(ctx.sent), 4)
+
+    async def test_repeated_polls_update_the_group_index(self):
+        now = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+        group_indexes = GroupIndexCache()
+        with MockBddServer(latency=0.01) as server:
+            with mock.patch('core.BDD_URL', server.url), mock.patch('bot.datetime') as bot_datetime, \
+                    mock.patch('bot.group_indexes', group_indexes):
+                bot_datetime.datetime.utcnow.return_value = now
+                expected = await CustomBot.compute_poll(PLAYER_IDS, [4, 50000], 1, None, n_sessions=3)
+                result = await CustomBot.compute_poll(PLAYER_IDS[:2], [4, 50000], 1, None, n_sessions=3,
+                                                      group_key='group')
+                self.assertEqual(group_indexes.stats()['updated_players'], 2)
+                result = await CustomBot.compute_poll(PLAYER_IDS, [4, 50000], 1, None, n_sessions=3,
+                                                      group_key='group')
+                self.assertEqual(group_indexes.stats()['updated_players'], 3)
+                # Calendars fetched again, but which did not change, are not intersected again.
+                core.player_cache.clear()
+                result = await CustomBot.compute_poll(PLAYER_IDS, [4, 50000], 1, None, n_sessions=3,
+                                                      group_key='group')
+        self.assertEqual(group_indexes.stats(), {'groups': 1, 'players': 3, 'builds': 1, 'updates': 2,
+                                                 'updated_players': 3})
+        self.assertEqual(result, expected)
+
+    async def test_next_session_uses_the_group_index_only_if_built(self):
+        now = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+        group_indexes = GroupIndexCache()
+        with MockBddServer(latency=0.01) as server:
+            with mock.patch('core.BDD_URL', server.url), mock.patch('bot.datetime') as bot_datetime, \
+                    mock.patch('bot.group_indexes', group_indexes), \
+                    mock.patch('core.find_first_intersection', wraps=core.find_first_intersection) as first_fit:
+                bot_datetime.datetime.utcnow.return_value = now
+                expected = await CustomBot.compute_poll(PLAYER_IDS, [4], 1, None, group_key='group')
+                self.assertEqual(first_fit.call_count, 1)
+                self.assertEqual(len(group_indexes), 0)
+                await CustomBot.compute_poll(PLAYER_IDS, [4], 1, None, n_sessions=2, group_key='group')
+                result = await CustomBot.compute_poll(PLAYER_IDS, [4], 1, None, group_key='group')
+        self.assertEqual(first_fit.call_count, 1)
+        self.assertEqual(group_indexes.stats()['updates'], 1)
+        self.assertEqual(result, expected)
+
+    async def test_slow_and_failing_members_are_reported(self):
+        def events_provider(player_id, start_time, end_time):
+            if player_id == str(PLAYER_IDS[0]):
+                time.sleep(1)
+            if player_id == str(PLAYER_IDS[1]):
+                raise RuntimeError('API failure')
+            return mock_events_provider(player_id, start_time, end_time)
+
+        members = [FakeMember(player_id) for player_id in PLAYER_IDS]
+        ctx = make_context(members, members)
+        with MockBddServer(latency=0.05, events_provider=events_provider) as server:
+            with mock.patch('core.BDD_URL', server.url), mock.patch('bot.FETCH_DEADLINE', 0.5), \
+                    mock.patch('bot.PROGRESS_INTERVAL', 0), mock.patch('bdd_handler.RETRY_BACKOFF', 0):
+                await CustomBot.run_poll(ctx, members, False, [], [4], 1, None)
+            # The failing member is queried once, then retried.
+            self.assertEqual(server.n_requests, 2 + bdd_handler.MAX_RETRIES + 1)
+        self.assertEqual(ctx.sent[-1], '<@{}>, <@{}> could not be reached in time: their availabilities were not '
+                                       'taken into account.'.format(PLAYER_IDS[0], PLAYER_IDS[1]))
+        # The provisional result, computed from the only member fetched, is shown, then replaced.
+        progress_edits = ctx.messages[0].edits
+        self.assertTrue(progress_edits[0].startswith('Poll started. 1/3 calendars fetched so far, provisional next '
+                                                     'session'))
+        self.assertEqual(progress_edits[-1], 'Poll started. 1/3 calendars fetched.')
+
+
+class LoadTestTestCase(unittest.TestCase):
+    def test_load_test_runs_polls_end_to_end(self):
+        results = load_test.run_load_test(n_guilds=2, n_members=20, n_roles=3, n_polls=6, concurrency=3, latency=0.01,
+                                          error_rate=0.2, options=['-t', '01:00', '-n', '2'])
+        self.assertEqual(sum(n_polls for outcome, n_polls in results['outcomes'].items() if outcome != 'unreachable'),
+                         6)
+        self.assertNotIn('failed', results['outcomes'])
+        self.assertGreater(results['requests'], 0)
+        self.assertLessEqual(results['latency']['p50'], results['latency']['p99'])
+        self.assertGreater(results['loop']['samples'], 0)
+
+
+class MemberIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.guild = SimpleNamespace(id=0, members=[])
+        self.roles = [SimpleNamespace(id=role_id, guild=self.guild) for role_id in (1, 2, 3)]
+        self.guild.members = [FakeMember(10, self.roles[:1], guild=self.guild),
+                              FakeMember(11, self.roles[:2], guild=self.guild),
+                              FakeMember(12, self.roles[1:2], guild=self.guild),
+                              FakeMember(13, self.roles, bot=True, guild=self.guild)]
+        self.index = MemberIndex()
+
+    def test_resolve(self):
+        members = self.guild.members
+        self.assertEqual(self.index.resolve(self.guild, self.roles[:1], members[2:]), {10, 11, 12})
+        self.assertEqual(self.index.resolve(self.guild, self.roles[2:]), set())
+        self.assertEqual(self.index.resolve(self.guild, everyone=True), {10, 11, 12})
+        everyone_role = SimpleNamespace(id=self.guild.id, guild=self.guild)
+        self.assertEqual(self.index.resolve(self.guild, [everyone_role]), {10, 11, 12})
+
+    def test_index_follows_events(self):
+        self.index.resolve(self.guild)
+        self.index.add_member(FakeMember(14, self.roles[2:], guild=self.guild))
+        self.assertEqual(self.index.resolve(self.guild, self.roles[2:]), {14})
+        before = self.guild.members[0]
+        self.index.update_member(before, FakeMember(10, self.roles[1:2], guild=self.guild))
+        self.assertEqual(self.index.resolve(self.guild, self.roles[:1]), {11})
+        self.assertEqual(self.index.resolve(self.guild, self.roles[1:2]), {10, 11, 12})
+        self.index.remove_member(self.guild.members[2])
+        self.index.remove_role(self.roles[0])
+        self.assertEqual(self.index.resolve(self.guild, self.roles[:2]), {10, 11})
+
+
+if __name__ == '__main__':
+    unittest.main()
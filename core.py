@@ -1,8 +1,91 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import os
+import sqlite3
+import time
 import numpy as np
-import pandas as pd
 from datetime import timezone
 import datetime
 import bdd_handler
+from availability_cache import AvailabilityCache, slice_events
+from metrics import registry as metrics
+from single_flight import SingleFlight
+from snapshot_store import SnapshotStore
+from interval_table import IntervalTable
+import workers
+
+logger = logging.getLogger(__name__)
+
+# Root of the availability API. Can be overridden to point the bot to a local stand-in (see bdd_server_mock).
+BDD_URL = os.getenv('BDD_URL', 'https://api.dispos.pocot.fr')
+
+# Cache of the events of players, shared by all polls.
+player_cache = AvailabilityCache(ttl=float(os.getenv('CACHE_TTL', 300)),
+                                 max_events=int(os.getenv('CACHE_MAX_EVENTS', 200000)))
+metrics.register_gauge('cache', player_cache.stats)
+
+# Period (in milliseconds) of repeatable events of the BDD.
+REPEAT_PERIOD = 7 * 24 * 3600 * 1000
+
+# Resolution (in milliseconds, as timestamps of calendars) of the grid engine, and sizes from which it is used instead of
+# the exact sweep by find_first_intersection(engine='auto'): number of players, and maximum number of cells of the grid.
+GRID_RESOLUTION = int(os.getenv('GRID_RESOLUTION', 5 * 60 * 1000))
+GRID_MIN_PLAYERS = int(os.getenv('GRID_MIN_PLAYERS', 1000))
+GRID_MAX_CELLS = int(os.getenv('GRID_MAX_CELLS', 100000))
+
+# Queries to the BDD in flight, shared by concurrent polls. Queries polls gave up on complete in the background, to fill
+# the cache for later polls.
+player_fetches = SingleFlight(cancel_abandoned=False)
+metrics.register_gauge('fetch_coalescing', player_fetches.stats)
+
+# Persistent store of the events of players, so that a restarted bot does not query the BDD for everyone at once.
+# Disabled if SNAPSHOT_STORE_PATH is not set. Snapshots older than SNAPSHOT_REFRESH_AGE seconds are refreshed, and those
+# older than SNAPSHOT_MAX_AGE seconds are ignored.
+snapshot_store = SnapshotStore(os.getenv('SNAPSHOT_STORE_PATH')) if os.getenv('SNAPSHOT_STORE_PATH') else None
+SNAPSHOT_REFRESH_AGE = float(os.getenv('SNAPSHOT_REFRESH_AGE', 300))
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', 24 * 3600))
+# Players whose snapshot was read since startup. Polls are answered from stale snapshots (refreshed in the background)
+# only the first time, to warm up a restarted bot: later on, stale calendars are fetched before answering.
+_restored_players = set()
+# Background refreshes of snapshots in flight.
+_refresh_tasks = set()
+# Snapshots of calendars fetched by the event loop, waiting to be stored (player id -> (player_id, start_time, end_time,
+# events, fetched_at)). They are written together, in a single transaction and off the event loop,
+# SNAPSHOT_FLUSH_DELAY seconds after the first of them.
+SNAPSHOT_FLUSH_DELAY = float(os.getenv('SNAPSHOT_FLUSH_DELAY', 1))
+_pending_snapshots = {}
+_flush_task = None
+
+def as_interval_table(intervals):
+    """
+    :param intervals: IntervalTable, or list of np.array of shape (N,2) (or None), one per player.
+    :return: IntervalTable of intervals.
+    """
+    if isinstance(intervals, IntervalTable):
+        return intervals
+    return IntervalTable.from_arrays(intervals)
+
+
+def _get_valid_players(intervals, minimum_length):
+    """
+    Validates arguments of the intersection engines and returns the table of players which filled their
+    availabilities, along with their indices in intervals.
+    See find_intersections for the contract on intervals and minimum_length.
+    """
+    table = as_interval_table(intervals)
+    if len(table) == 0:
+        raise ValueError('Invalid number of players: intervals should contain at least one entry.')
+
+    if minimum_length <= 0:
+        raise ValueError('Minimum length must be strictly positive!')
+
+    valid_indices = np.flatnonzero(table.valid)
+    if valid_indices.shape[0] == 0:
+        raise ValueError('No valid intervals! Players did not fill in their calendars!')
+    return table.select(valid_indices), valid_indices
+
 
 def find_intersections(intervals, minimum_length):
     """
@@ -16,6 +99,512 @@ def find_intersections(intervals, minimum_length):
     It is also possible to constrain the search of intervals to keep only intervals of at least a specific minimum
     length.
 
+    The search is a sweep over the events of all players at once: every start of interval is a +1 event, every end a
+    -1 event. Once events are sorted by time (ends before starts when they happen at the same time), a cumulative sum
+    gives, between two consecutive events, how many players are available. Intervals where all players are available
+    are those following an event bringing this count to the number of players, and they end at the next event.
+    This is O(T log T), T being the total number of intervals, and produces the same output as
+    find_intersections_reference, as long as intervals of a given player do not overlap (which convert_player_json
+    guarantees for well formed calendars). Touching intervals of a player are not merged.
+
+    :param intervals: IntervalTable or list[np.array]
+    Every player returns a list of intervals. We here expect to receive concatenation of all these intervals (ie: each
+    entry of this list is a list of intervals). We further assume that the list of intervals is in numpy format of shape
+     (N,2), N being the list of events for the considered player. Intervals of a player need not be sorted.
+    Intervals can also be given as an IntervalTable (as returned by convert_players_json), which spares concatenating
+    them.
+    Cannot be an empty list, or a ValueError is thrown.
+    Must contain at least one player with availabilities, or a ValueError is thrown.
+    A player's availability MUST be a numpy array of shape (N,2) or a ValueError will be thrown. (N doesn't have to be
+    the same for all players).
+
+    :param minimum_length: int
+    Minimum length of valid intervals. Must be strictly positive, or a value error will be thrown.
+
+    :return: found_intervals: list
+    List of found intervals, sorted by start, if any, or an empty array if no interval was found. Bounds of intervals
+    are ints, as timestamps of calendars.
+    If a single player is passed, availabilities of the player will be returned.
+    """
+    table, _ = _get_valid_players(intervals, minimum_length)
+    return _sweep_intersections(table.starts, table.ends, len(table), minimum_length).tolist()
+
+
+def _sweep_intersections(starts, ends, n_players, minimum_length):
+    """
+    Sweep at the heart of find_intersections.
+    :param starts: np.array of int64 of shape (T,), starts of the intervals of all players.
+    :param ends: np.array of int64 of shape (T,), ends of the intervals of all players.
+    :param n_players: number of players the intervals belong to.
+    :param minimum_length: minimum length of intervals to keep.
+    :return: np.array of int64 of shape (M,2) of intervals where all players are available, sorted by start.
+    """
+    n_intervals = starts.shape[0]
+
+    times = np.concatenate((starts, ends))
+    deltas = np.concatenate((np.ones(n_intervals, dtype=np.int64), -np.ones(n_intervals, dtype=np.int64)))
+
+    # Sort by time, and at equal time put ends (-1) before starts (+1): touching intervals must not be seen as
+    # overlapping, otherwise an end and a start at the same time would look like an uninterrupted availability.
+    order = np.lexsort((deltas, times))
+    times = times[order]
+    coverage = np.cumsum(deltas[order])
+
+    # When coverage reaches n_players, every player is available until the next event, which can only be an end.
+    # The last event is always an end (coverage 0 afterwards), so opening events always have a successor.
+    opening = np.flatnonzero(coverage[:-1] == n_players)
+    found = np.column_stack((times[opening], times[opening + 1]))
+    return found[found[:, 1] - found[:, 0] >= minimum_length]
+
+
+def intersect_calendars(first, second):
+    """
+    Intersects two calendars (of players, or of groups of players, see group_index.GroupIntersectionIndex), by merging
+    them rather than sweeping them.
+    :param first: np.array of int64 of shape (N,2) of non overlapping intervals sorted by start, or None for no
+    constraint (the other calendar is returned).
+    :param second: same as first.
+    :return: np.array of int64 of shape (M,2) of the non overlapping intervals sorted by start where both calendars are
+    available, or None if both are None.
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    # Intervals of second overlapping an interval of first are consecutive: from the first one ending after it starts,
+    # to the last one starting before it ends (touching intervals do not overlap).
+    lows = np.searchsorted(second[:, 1], first[:, 0], side='right')
+    highs = np.searchsorted(second[:, 0], first[:, 1], side='left')
+    counts = np.maximum(highs - lows, 0)
+    first_indices = np.repeat(np.arange(first.shape[0]), counts)
+    second_indices = np.repeat(lows - (np.cumsum(counts) - counts), counts) + np.arange(first_indices.shape[0])
+    return np.column_stack((np.maximum(first[first_indices, 0], second[second_indices, 0]),
+                            np.minimum(first[first_indices, 1], second[second_indices, 1])))
+
+
+def iter_intersections(intervals, minimum_length):
+    """
+    Lazy counterpart of find_intersections: yields the same intervals, in the same order, but only sorts the part of
+    calendars needed to produce them. Stopping the iteration early (for instance once the first interval is found)
+    therefore costs about the same whatever the length of the calendars.
+
+    Calendars are processed up to a horizon which doubles at each round: intervals of players starting before the
+    horizon are swept, with their end truncated to the horizon. Found intervals ending strictly before the horizon
+    cannot be changed by intervals starting later and are yielded, the others are found again in the next round.
+
+    See find_intersections for the meaning of arguments and for errors.
+    """
+    table, _ = _get_valid_players(intervals, minimum_length)
+    n_players = len(table)
+    if np.any(table.counts() == 0):
+        return
+
+    last_end = table.ends.max()
+
+    # Intersections cannot start before all players have started their first interval, so this is where rounds start
+    # looking from.
+    first_start = np.minimum.reduceat(table.starts, table.offsets[:-1]).max()
+    span = 4 * minimum_length
+    horizon = first_start + span
+    n_yielded = 0
+    while horizon <= last_end:
+        prefix = table.starts < horizon
+        found = _sweep_intersections(table.starts[prefix], np.minimum(table.ends[prefix], horizon), n_players,
+                                     minimum_length)
+        found = found[found[:, 1] < horizon]
+        for interval in found[n_yielded:].tolist():
+            yield interval
+        n_yielded = found.shape[0]
+        span *= 2
+        horizon = first_start + span
+
+    found = _sweep_intersections(table.starts, table.ends, n_players, minimum_length)
+    for interval in found[n_yielded:].tolist():
+        yield interval
+
+
+def find_first_intersection(intervals, minimum_length, engine='sweep'):
+    """
+    Returns the earliest interval of at least minimum_length where all players are available, or None if there is
+    none. Stops looking at calendars as soon as it is found, see iter_intersections.
+
+    :param engine: str
+    'sweep' for the exact engine (iter_intersections), 'grid' for find_intersections_grid, which is exact up to
+    GRID_RESOLUTION only, or 'auto' to let choose_engine pick one based on the size of the problem.
+    """
+    if engine == 'auto':
+        engine = choose_engine(intervals)
+    if engine == 'grid':
+        found_intervals = find_intersections_grid(intervals, minimum_length)
+        return found_intervals[0] if found_intervals else None
+    return next(iter_intersections(intervals, minimum_length), None)
+
+
+def find_top_intersections(intervals, minimum_length, k, longest=True):
+    """
+    Returns at most k intervals of at least minimum_length where all players are available.
+
+    :param k: int
+    Maximum number of intervals to return. Must be strictly positive, or a ValueError is thrown.
+    :param longest: bool
+    If True, the k longest intervals are returned, longest first (ties are broken by earliest start), as by
+    IntersectionSet.best. Otherwise, the k earliest intervals are returned, earliest first, and calendars are only
+    looked at until they are found.
+    :return: list of intervals
+    """
+    if k <= 0:
+        raise ValueError('Number of intervals to return must be strictly positive!')
+    if not longest:
+        return list(itertools.islice(iter_intersections(intervals, minimum_length), k))
+    # All intervals are needed to know the longest ones.
+    return [interval for interval, _ in find_intersection_set(intervals, minimum_length).best(minimum_length, k, True)]
+
+
+def iter_quorum_intersections(intervals, minimum_length, quorum):
+    """
+    Quorum counterpart of iter_intersections: yields intervals of at least minimum_length where at least quorum
+    players (the same ones during the whole interval) are available, along with the players who are not.
+
+    A coverage sweep over the intervals of all players finds the runs where at least quorum players are available at
+    every moment. Within such a run, the interval starting at s is as long as the quorum-th largest end among intervals
+    of players available at s. A second pass over the same sorted events keeps the intervals available at the current
+    time sorted by end, so that this end is read at every candidate start rather than searched for: O(T log T) for T
+    intervals, plus the size of the lists of missing players yielded. Only runs of at least minimum_length are looked
+    into. Yielded intervals are maximal: none is included in another one, and they are sorted by start.
+    With quorum equal to the number of players who filled their availabilities, the same intervals as
+    find_intersections are yielded.
+
+    :param intervals: IntervalTable or list[np.array]
+    See find_intersections. Players with None instead of intervals (or flagged as not valid in the table) are ignored,
+    and not counted in missing players.
+    :param minimum_length: int
+    See find_intersections.
+    :param quorum: int
+    Minimum number of players available. Must be strictly positive and at most the number of players who filled their
+    availabilities, or a ValueError is thrown.
+    :return: generator of tuples (interval, missing_players), where interval is [start, end] and missing_players the
+    list of indices (in intervals) of players not available during the whole interval.
+    """
+    table, valid_indices = _get_valid_players(intervals, minimum_length)
+    _check_quorum(table, quorum)
+    owners = table.owners()
+    for start, end, active, first_present in _sweep_quorum_intersections(table, minimum_length, quorum):
+        missing = np.ones(len(table), dtype=bool)
+        missing[owners[[interval for _, interval in active[first_present:]]]] = False
+        yield [start, end], valid_indices[missing].tolist()
+
+
+def _check_quorum(table, quorum):
+    if quorum <= 0 or quorum > len(table):
+        raise ValueError('Quorum must be between 1 and the number of players with availabilities ({}), got {} '
+                         'instead.'.format(len(table), quorum))
+
+
+def _sweep_quorum_intersections(table, minimum_length, quorum):
+    """
+    Sweep at the heart of iter_quorum_intersections, over the table of players who filled their availabilities.
+    :return: generator of tuples (start, end, active, first_present), where active is the list of (end, interval index)
+    of intervals available at start, sorted by end, those from first_present on being available during the whole
+    interval. active is only valid until the generator is resumed.
+    """
+    starts = table.starts
+    ends = table.ends
+    n_intervals = table.n_intervals
+    if n_intervals == 0:
+        return
+
+    times = np.concatenate((starts, ends))
+    deltas = np.concatenate((np.ones(n_intervals, dtype=np.int64), -np.ones(n_intervals, dtype=np.int64)))
+    order = np.lexsort((deltas, times))
+    times = times[order]
+    coverage = np.cumsum(deltas[order])
+
+    # Segment i goes from event i to event i+1. Runs are maximal sequences of segments with enough players available.
+    enough = np.concatenate(([False], coverage[:-1] >= quorum, [False]))
+    run_starts = times[np.flatnonzero(enough[1:] & ~enough[:-1])]
+    run_ends = times[np.flatnonzero(~enough[1:] & enough[:-1])]
+    long_runs = run_ends - run_starts >= minimum_length
+    run_starts = run_starts[long_runs].tolist()
+    run_ends = run_ends[long_runs].tolist()
+    if len(run_starts) == 0:
+        return
+
+    # Every player has at most one interval available at a time, so there are at most as many active intervals as
+    # players.
+    times = times.tolist()
+    events = order.tolist()
+    ends = ends.tolist()
+    active = []
+    run = 0
+    last_end = run_starts[0]
+    started = False
+    for i, event in enumerate(events):
+        if event < n_intervals:
+            bisect.insort(active, (ends[event], event))
+            started = True
+        else:
+            event -= n_intervals
+            del active[bisect.bisect_left(active, (ends[event], event))]
+        # Candidate starts are the start of runs and starts of intervals within runs, once all events at the same
+        # time are applied.
+        start = times[i]
+        if not started or (i + 1 < len(events) and times[i + 1] == start):
+            continue
+        started = False
+        while start >= run_ends[run]:
+            run += 1
+            if run == len(run_starts):
+                return
+            last_end = run_starts[run]
+        if start < run_starts[run] or last_end >= run_ends[run] or len(active) < quorum:
+            continue
+        end = active[len(active) - quorum][0]
+        # Intervals ending no later than the previous one are included in it.
+        if end > last_end and end - start >= minimum_length:
+            yield start, end, active, bisect.bisect_left(active, (end, -1))
+        last_end = max(last_end, end)
+
+
+def _get_missing_players(table, valid_indices, start, end):
+    """
+    :return: list of indices (in valid_indices) of players of the table with no interval covering [start, end].
+    """
+    missing = np.ones(len(table), dtype=bool)
+    missing[table.owners()[(table.starts <= start) & (table.ends >= end)]] = False
+    return valid_indices[missing].tolist()
+
+
+def find_quorum_intersections(intervals, minimum_length, quorum):
+    """
+    Returns the list of all intervals yielded by iter_quorum_intersections.
+    """
+    return list(iter_quorum_intersections(intervals, minimum_length, quorum))
+
+
+def find_first_quorum_intersection(intervals, minimum_length, quorum):
+    """
+    Returns the first interval yielded by iter_quorum_intersections and its missing players, or (None, []) if there is
+    none.
+    """
+    return next(iter_quorum_intersections(intervals, minimum_length, quorum), (None, []))
+
+
+class IntersectionSet:
+    """
+    Intervals where players are available (or enough of them, with a quorum), found once for the smallest minimum
+    length of interest and indexed by length, so that the best intervals for any longer minimum length are found
+    without sweeping calendars again. Longer minimum lengths select a subset of the intervals found for shorter ones.
+    """
+    def __init__(self, found, missing=None):
+        """
+        :param found: np.array of int64 of shape (M,2) of intervals, sorted by start.
+        :param missing: list of M lists of indices of players missing from every interval, or a function returning the
+        list of interval i (so that they are only listed for intervals selected), or None if all players are available
+        during every interval.
+        """
+        self.found = found
+        self.missing = missing
+        self.lengths = found[:, 1] - found[:, 0]
+        # Intervals from the longest to the shortest (earliest first among intervals of the same length).
+        self._by_length = np.argsort(-self.lengths, kind='stable')
+        self._sorted_lengths = self.lengths[self._by_length]
+
+    def __len__(self):
+        return self.found.shape[0]
+
+    def best(self, minimum_length, k=1, longest=False):
+        """
+        :return: list of at most k tuples (interval, missing_players) of intervals of at least minimum_length, the
+        earliest first, or the longest first if longest is True (ties are broken by earliest start).
+        """
+        n_long_enough = np.searchsorted(-self._sorted_lengths, -minimum_length, side='right')
+        selected = self._by_length[:n_long_enough]
+        selected = selected[:k] if longest else np.sort(selected)[:k]
+        return [(self.found[i].tolist(), self._get_missing(i)) for i in selected]
+
+    def _get_missing(self, i):
+        if self.missing is None:
+            return []
+        if callable(self.missing):
+            return self.missing(i)
+        return self.missing[i]
+
+
+def find_intersection_set(intervals, minimum_length, quorum=None, engine='sweep'):
+    """
+    Finds all intervals of at least minimum_length where all players are available (or at least quorum of them, see
+    iter_quorum_intersections), in a single sweep. See find_first_intersection for engine (which is ignored with a
+    quorum).
+    :return: IntersectionSet
+    """
+    if quorum is not None:
+        table, valid_indices = _get_valid_players(intervals, minimum_length)
+        _check_quorum(table, quorum)
+        found = np.array([(start, end) for start, end, _, _ in _sweep_quorum_intersections(table, minimum_length, quorum)],
+                         dtype=np.int64).reshape(-1, 2)
+        return IntersectionSet(found, lambda i: _get_missing_players(table, valid_indices, found[i, 0], found[i, 1]))
+    if engine == 'auto':
+        engine = choose_engine(intervals)
+    if engine == 'grid':
+        found = find_intersections_grid(intervals, minimum_length)
+        return IntersectionSet(np.array(found, dtype=np.int64).reshape(-1, 2))
+    table, _ = _get_valid_players(intervals, minimum_length)
+    return IntersectionSet(_sweep_intersections(table.starts, table.ends, len(table), minimum_length))
+
+
+def find_best_intersections(intervals, minimum_lengths, k=1, longest=False, quorum=None, engine='sweep'):
+    """
+    Finds the best intervals for several minimum lengths at once: intervals are found for the smallest one only (see
+    find_intersection_set).
+    :return: dict mapping every minimum length to the list of at most k (interval, missing_players) returned by
+    IntersectionSet.best.
+    """
+    if len(minimum_lengths) == 0:
+        raise ValueError('At least one minimum length is expected!')
+    intersections = find_intersection_set(intervals, min(minimum_lengths), quorum=quorum, engine=engine)
+    return {minimum_length: intersections.best(minimum_length, k, longest) for minimum_length in minimum_lengths}
+
+
+def choose_engine(intervals, resolution=GRID_RESOLUTION):
+    """
+    Picks the engine to find intersections of intervals with: 'grid' for groups of at least GRID_MIN_PLAYERS players,
+    as long as the grid holds at most GRID_MAX_CELLS cells (the cost of the grid grows with the window, that of the
+    sweep with the number of intervals), 'sweep' otherwise.
+    """
+    table = as_interval_table(intervals)
+    if np.count_nonzero(table.counts() > 0) < GRID_MIN_PLAYERS:
+        return 'sweep'
+    window = table.ends.max() - table.starts.min()
+    return 'grid' if window <= GRID_MAX_CELLS * resolution else 'sweep'
+
+
+def build_availability_grid(intervals, origin, resolution, n_cells, chunk_size=256):
+    """
+    Builds the availability grid of players: cell j of a player's row is set if the player is available during the
+    whole of [origin + j*resolution, origin + (j+1)*resolution). Rows are packed (8 cells per byte, see np.packbits).
+    Players are processed by chunks of chunk_size, to bound the memory used by the unpacked rows.
+
+    :param intervals: IntervalTable of valid players.
+    :return: np.array of uint8 of shape (n_players, ceil(n_cells / 8))
+    """
+    n_players = len(intervals)
+    counts = intervals.counts()
+    grid = np.zeros((n_players, (n_cells + 7) // 8), dtype=np.uint8)
+    for chunk_start in range(0, n_players, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_players)
+        n_chunk = chunk_end - chunk_start
+        rows_slice = slice(intervals.offsets[chunk_start], intervals.offsets[chunk_end])
+        starts = intervals.starts[rows_slice]
+        ends = intervals.ends[rows_slice]
+        owners = np.repeat(np.arange(n_chunk), counts[chunk_start:chunk_end])
+
+        # Touching intervals of a player are merged first, otherwise a cell straddling the point where they touch
+        # would not be seen as covered. Intervals of players are usually already sorted (see convert_player_json).
+        if np.any((owners[1:] == owners[:-1]) & (starts[1:] < starts[:-1])):
+            order = np.lexsort((starts, owners))
+            starts = starts[order]
+            ends = ends[order]
+            owners = owners[order]
+        new_groups = np.ones(starts.shape[0], dtype=bool)
+        new_groups[1:] = (owners[1:] != owners[:-1]) | (starts[1:] > ends[:-1])
+        group_starts = np.flatnonzero(new_groups)
+        if group_starts.shape[0] != 0:
+            starts, ends = starts[group_starts], np.maximum.reduceat(ends, group_starts)
+            owners = owners[group_starts]
+
+        # Only cells fully covered by an interval are set: starts are rounded up and ends down to the grid.
+        first_cells = np.clip(-((origin - starts) // resolution), 0, n_cells)
+        last_cells = np.clip((ends - origin) // resolution, 0, n_cells)
+        covering = first_cells < last_cells
+        first_cells = owners[covering] * (n_cells + 1) + first_cells[covering]
+        last_cells = owners[covering] * (n_cells + 1) + last_cells[covering]
+
+        # Difference array: +1 where intervals start, -1 where they end, a cumulative sum then gives the rows. Once
+        # merged, intervals of a player cover disjoint cells, so first cells are unique, and so are last cells.
+        changes = np.zeros(n_chunk * (n_cells + 1), dtype=np.int8)
+        changes[first_cells] = 1
+        changes[last_cells] -= 1
+        rows = np.cumsum(changes.reshape(n_chunk, n_cells + 1)[:, :n_cells], axis=1, dtype=np.int8) > 0
+        grid[chunk_start:chunk_end] = np.packbits(rows, axis=1)
+    return grid
+
+
+def _get_grid_bounds(table, resolution):
+    if table.n_intervals == 0:
+        return 0, 0
+    origin = int(table.starts.min() // resolution) * resolution
+    n_cells = int(-((origin - table.ends.max()) // resolution))
+    return origin, n_cells
+
+
+def find_intersections_grid(intervals, minimum_length, resolution=GRID_RESOLUTION):
+    """
+    Approximate counterpart of find_intersections, meant for very large groups: intervals of players are put on a grid
+    of the given resolution (see build_availability_grid), rows of all players are ANDed together, and runs of
+    available cells at least minimum_length long are returned.
+    Since only cells fully covered by intervals are set, found intervals are included in intervals found by
+    find_intersections, and are shorter by less than resolution at each end. Touching intervals of a player are merged.
+
+    :param resolution: length of cells of the grid, in the unit of intervals (milliseconds for calendars).
+    See find_intersections for other arguments, errors and the returned value.
+    """
+    table, _ = _get_valid_players(intervals, minimum_length)
+    origin, n_cells = _get_grid_bounds(table, resolution)
+    if n_cells == 0:
+        return []
+    grid = build_availability_grid(table, origin, resolution, n_cells)
+    available = np.unpackbits(np.bitwise_and.reduce(grid, axis=0))[:n_cells].astype(bool)
+    return _extract_runs(available, origin, resolution, minimum_length)
+
+
+def count_available_grid(intervals, resolution=GRID_RESOLUTION):
+    """
+    Partial availability counterpart of find_intersections_grid: counts, for every cell of the grid, how many players
+    are available during the whole cell. Players with None instead of intervals are ignored.
+    :return: (origin, counts), counts being an np.array with the number of players available in every cell, cell j
+    starting at origin + j*resolution.
+    """
+    table = as_interval_table(intervals)
+    if not np.any(table.valid):
+        raise ValueError('No valid intervals! Players did not fill in their calendars!')
+    table = table.select(np.flatnonzero(table.valid))
+    origin, n_cells = _get_grid_bounds(table, resolution)
+    counts = np.zeros(n_cells, dtype=np.int64)
+    if n_cells == 0:
+        return origin, counts
+    grid = build_availability_grid(table, origin, resolution, n_cells)
+    for chunk_start in range(0, grid.shape[0], 256):
+        counts += np.unpackbits(grid[chunk_start:chunk_start + 256], axis=1)[:, :n_cells].sum(axis=0, dtype=np.int64)
+    return origin, counts
+
+
+def _extract_runs(cells, origin, resolution, minimum_length):
+    """
+    Returns the [start, end] of runs of set cells lasting at least minimum_length.
+    """
+    changes = np.diff(np.concatenate(([0], cells.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(changes == 1)
+    run_ends = np.flatnonzero(changes == -1)
+    found = np.column_stack((origin + run_starts * resolution, origin + run_ends * resolution))
+    return found[found[:, 1] - found[:, 0] >= minimum_length].tolist()
+
+
+def find_intersections_reference(intervals, minimum_length):
+    """
+    Reference (iterative) implementation of find_intersections, kept to check the sweep-line engine against.
+    It advances the iterator of the player with the smallest end at every step, and is therefore
+    O(total_intervals x n_players). Use find_intersections instead.
+
+    This function is tasked with finding intersection between intervals of availabilities between players.
+    A player has zero or more availabilities. An availability is nothing but a tuple (a,b), a<b where a is the start
+    time of the availability and b is the end time of the availability.
+    A player therefore simply has an array of such availabilities.
+    This algorithm is tasked with intersecting availabilities of several players to find intervals where all players
+    are available.
+
+    It is also possible to constrain the search of intervals to keep only intervals of at least a specific minimum
+    length.
+
     Do note that the algorithm deals with numbers. We talk of availabilities to make the algorithm intent clear, but
     it really only deal with intervals and has no notion of dates or even time for that matter.
     To reflect this better, the code only speaks of intervals, from arguments down to variables.
@@ -79,9 +668,10 @@ def find_intersections(intervals, minimum_length):
         # End of an interval intersecting all availabilities is the minimum of all player's ends (Closest ending point)
         end_interval = np.min(ends)
 
-        print('{} - {} (diff is : {}, minimum length is {})'.format(start_interval, end_interval, end_interval-start_interval, minimum_length))
-        print('Starts : {} '.format(starts))
-        print('Ends : {} '.format(ends))
+        logger.debug('%s - %s (diff is : %s, minimum length is %s)', start_interval, end_interval,
+                     end_interval-start_interval, minimum_length)
+        logger.debug('Starts : %s ', starts)
+        logger.debug('Ends : %s ', ends)
 
         # Add the current interval to good intervals if it is valid. An interval is valid under two conditions:
         # 1) it must be strictly positive
@@ -117,9 +707,18 @@ def find_intersections(intervals, minimum_length):
             break
     return found_intervals
 
+def get_player_url(player_id, start_time, end_time):
+    """
+    Builds the url with which to query the BDD for the events of a player between start_time and end_time.
+    """
+    return BDD_URL+"/events/"+str(player_id)+"?from="+str(start_time) +"&to="+str(end_time)
+
+
 def get_player_json(player_id, start_time, end_time):
     """
-    This method uses the provided player_id to query the BDD and get the player's JSON (as a string)
+    This method uses the provided player_id to query the BDD and get the player's events, as an array (see
+    events_to_array). The in-process cache and the snapshot store are consulted first. Stale snapshots are refreshed
+    before being returned (get_player_json_async refreshes them in the background instead).
 
     :param player_id: int
     Discord id of the player
@@ -127,13 +726,293 @@ def get_player_json(player_id, start_time, end_time):
     Unix timestamp of start time (moment where we start to look for availabilities of the considered player)
     :param end_time: int
     Unix timestamp of end time (moment where we stop looking for availabilities of the considered player)
-    :return: player_json: string
-    String representing the player's JSON in the BDD.
+    :return: events: np.array of int64 of shape (N,3)
+    Events of the player in the BDD.
+    """
+    events = player_cache.get(player_id, start_time, end_time)
+    if events is None:
+        events, age = _get_snapshot(player_id, start_time, end_time)
+        if events is None or age > SNAPSHOT_REFRESH_AGE:
+            events = _fetch_player_json(player_id, start_time, end_time)
+        else:
+            player_cache.put(player_id, start_time, end_time, events)
+    return events
+
+
+def _fetch_player_json(player_id, start_time, end_time):
+    """
+    Queries the BDD for the events of the player, and caches and stores them.
+    """
+    url_query = get_player_url(player_id, start_time, end_time)
+    logger.debug('Querying %s', url_query)
+    metrics.increment('api_requests')
+    try:
+        with metrics.timer('api_request'):
+            json = bdd_handler.query_bdd_for_player(url_query)
+    except Exception:
+        metrics.increment('api_errors')
+        logger.warning('Query %s failed', url_query, exc_info=True)
+        raise
+    return _save_events(player_id, start_time, end_time, events_to_array(json))
+
+
+async def get_player_json_async(player_id, start_time, end_time):
+    """
+    Non blocking counterpart of get_player_json, to be used from the bot's event loop.
+    Concurrent calls for the same player and window share a single query to the BDD. The first time the snapshot of a
+    player is read since startup, it is returned as is even if stale, and refreshed in the background. Later stale
+    snapshots are refreshed before being returned, as get_player_json does.
+    """
+    events = player_cache.get(player_id, start_time, end_time)
+    if events is None:
+        events, age = _get_snapshot(player_id, start_time, end_time)
+        if events is not None:
+            if age > SNAPSHOT_REFRESH_AGE and str(player_id) in _restored_players:
+                events = None
+            _restored_players.add(str(player_id))
+        if events is None:
+            events = await refresh_player_json_async(player_id, start_time, end_time)
+        elif age > SNAPSHOT_REFRESH_AGE:
+            _refresh_in_background(player_id, start_time, end_time)
+        else:
+            player_cache.put(player_id, start_time, end_time, events)
+    return events
+
+
+async def refresh_player_json_async(player_id, start_time, end_time):
+    """
+    Queries the BDD for the events of the player, even if they are cached or stored, and caches and stores them.
+    Concurrent calls for the same player and window share a single query.
+    """
+    return await player_fetches.run((str(player_id), start_time, end_time),
+                                    lambda: _fetch_player_json_async(player_id, start_time, end_time))
+
+
+async def _fetch_player_json_async(player_id, start_time, end_time):
+    """
+    Queries the BDD for the events of the player, and caches and stores them.
+    """
+    url_query = get_player_url(player_id, start_time, end_time)
+    logger.debug('Querying %s', url_query)
+    metrics.increment('api_requests')
+    try:
+        with metrics.timer('api_request'):
+            json = await bdd_handler.query_bdd_for_player_async(url_query)
+    except Exception:
+        metrics.increment('api_errors')
+        logger.warning('Query %s failed', url_query, exc_info=True)
+        raise
+    events = events_to_array(json)
+    player_cache.put(player_id, start_time, end_time, events)
+    if snapshot_store is not None:
+        _pending_snapshots[str(player_id)] = (player_id, start_time, end_time, events, time.time())
+        _schedule_snapshots_flush()
+    return events
+
+
+def _save_events(player_id, start_time, end_time, events):
+    player_cache.put(player_id, start_time, end_time, events)
+    if snapshot_store is not None:
+        try:
+            snapshot_store.put(player_id, start_time, end_time, events)
+        except sqlite3.Error:
+            # The store only spares queries after a restart: failing to write to it must not fail polls.
+            logger.warning('Could not store the snapshot of %s', player_id, exc_info=True)
+    return events
+
+
+def _schedule_snapshots_flush():
+    global _flush_task
+    if _flush_task is None:
+        _flush_task = asyncio.ensure_future(_flush_snapshots_later())
+
+
+async def _flush_snapshots_later():
+    global _flush_task
+    try:
+        while _pending_snapshots:
+            await asyncio.sleep(SNAPSHOT_FLUSH_DELAY)
+            await flush_snapshots()
+    finally:
+        _flush_task = None
+
+
+async def flush_snapshots():
+    """
+    Stores the snapshots of calendars fetched since the last flush, in a single transaction run in a thread, so that
+    writing them does not block the event loop.
+    """
+    if snapshot_store is None or not _pending_snapshots:
+        return
+    snapshots = list(_pending_snapshots.values())
+    _pending_snapshots.clear()
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, snapshot_store.put_many, snapshots)
+    except sqlite3.Error:
+        # The store only spares queries after a restart: failing to write to it must not fail polls.
+        logger.warning('Could not store the snapshots of %s players', len(snapshots), exc_info=True)
+
+
+def _get_snapshot(player_id, start_time, end_time):
+    """
+    :return: (events, age) of the stored snapshot of the player, sliced to the window, or (None, None) if there is no
+    store, no snapshot covering the window, or if it is older than SNAPSHOT_MAX_AGE.
+    """
+    if snapshot_store is None:
+        return None, None
+    # Snapshots not written yet are more recent than those of the store.
+    pending = _pending_snapshots.get(str(player_id))
+    if pending is not None and pending[1] <= start_time and pending[2] >= end_time:
+        snapshot = pending[3], pending[4]
+    else:
+        try:
+            snapshot = snapshot_store.get(player_id, start_time, end_time)
+        except sqlite3.Error:
+            logger.warning('Could not read the snapshot of %s', player_id, exc_info=True)
+            return None, None
+    if snapshot is None:
+        return None, None
+    events, fetched_at = snapshot
+    age = time.time() - fetched_at
+    if age > SNAPSHOT_MAX_AGE:
+        return None, None
+    metrics.increment('snapshot_hits')
+    return slice_events(events, start_time, end_time), age
+
+
+def _refresh_in_background(player_id, start_time, end_time):
+    """
+    Queries the BDD for the events of the player without waiting for the result, which replaces the stored snapshot.
+    """
+    metrics.increment('snapshot_refreshes')
+    task = asyncio.ensure_future(refresh_player_json_async(player_id, start_time, end_time))
+    # The event loop only keeps weak references to tasks.
+    _refresh_tasks.add(task)
+    task.add_done_callback(_forget_refresh)
+
+
+def _forget_refresh(task):
+    _refresh_tasks.discard(task)
+    # Errors were already logged by _fetch_player_json_async, retrieving them silences asyncio.
+    if not task.cancelled():
+        task.exception()
+
+
+def parse_player_json(player_json, start_time_strict, end_time, fetched_until=None):
+    """
+    Converts the JSON of a player (or its events array, see events_to_array) to an array of intervals. See
+    convert_player_json for the meaning of arguments and of the returned value.
+    The BDD returns every occurrence of repeatable events within the window queried, moved or deleted ones included:
+    they are taken as is. Only if the events were fetched for a shorter window, up to fetched_until (None for
+    end_time), are repeatable events expanded as weekly patterns past it (see expand_repeatable_events). Overlapping
+    intervals are then coalesced, so that the intersection engines get fewer, non overlapping intervals.
+    """
+    return parse_players_json([player_json], start_time_strict, end_time, fetched_until)[0]
+
+
+def events_to_array(player_json):
+    """
+    Converts the JSON of a player to its events array, the form calendars are cached and stored in.
+    :return: np.array of int64 of shape (N,3): start, end, and repeatable flag of every event.
+    """
+    if not player_json:
+        return np.empty((0, 3), dtype=np.int64)
+    try:
+        events = np.array([(event['start'], event['end'], event.get('repeatable', 0)) for event in player_json],
+                          dtype=np.int64)
+    except KeyError:
+        invalid_event = next(event for event in player_json if 'start' not in event or 'end' not in event)
+        raise KeyError('Player entries invalid: expected to find at start and end keys, but got {} instead'.format(list(invalid_event.keys())))
+    return events.reshape(-1, 3)
+
+
+def expand_repeatable_events(patterns, start_time_strict, end_time, period=REPEAT_PERIOD):
+    """
+    Expands weekly patterns over a window: a pattern [start, end] stands for the occurrences
+    [start + k*period, end + k*period], k >= 0. Only occurrences overlapping [start_time_strict, end_time] are returned.
+    The BDD may also return concrete occurrences of patterns, which then coincide with expanded ones: they are merged
+    by coalesce_intervals.
+
+    :param patterns: np.array of int64 of shape (P,2)
+    :return: np.array of int64 of shape (N,2), occurrences grouped by pattern, in increasing order.
+    """
+    return _expand_repeatable_events(patterns, start_time_strict, end_time, period)[0]
+
+
+def _expand_repeatable_events(patterns, start_time_strict, end_time, period):
+    """
+    See expand_repeatable_events.
+    :return: occurrences, and np.array of shape (N,) of the index of the pattern of every occurrence.
+    """
+    starts = patterns[:, 0]
+    ends = patterns[:, 1]
+    # First occurrence ending after start_time_strict, and last one starting before end_time.
+    first_k = np.maximum((start_time_strict - ends) // period + 1, 0)
+    last_k = (end_time - 1 - starts) // period
+    n_occurrences = np.maximum(last_k - first_k + 1, 0)
+
+    pattern_ids = np.repeat(np.arange(patterns.shape[0]), n_occurrences)
+    # Rank of every occurrence within its pattern, offset by the first occurrence of the pattern.
+    ranks = np.arange(pattern_ids.shape[0]) - np.repeat(np.cumsum(n_occurrences) - n_occurrences, n_occurrences)
+    offsets = (first_k[pattern_ids] + ranks) * period
+    occurrences = np.column_stack((starts[pattern_ids] + offsets, ends[pattern_ids] + offsets)).astype(np.int64)
+    return occurrences, pattern_ids
+
+
+def _get_repeatable_patterns(events, owners, period):
+    """
+    The BDD returns every occurrence of repeatable events within the queried window, all flagged as repeatable:
+    expanding each of them would expand the same pattern once per occurrence. Occurrences of a player with the same
+    length and the same time within the period are reduced to the earliest one.
+    :param events: np.array of int64 of shape (N,2) of repeatable events, owners: index of the player of every event.
+    :return: patterns (np.array of shape (P,2)) and the index of the player of every pattern.
+    """
+    if events.shape[0] < 2:
+        return events, owners
+    phases = events[:, 0] % period
+    lengths = events[:, 1] - events[:, 0]
+    order = np.lexsort((events[:, 0], lengths, phases, owners))
+    first = np.ones(order.shape[0], dtype=bool)
+    first[1:] = (owners[order[1:]] != owners[order[:-1]]) | (phases[order[1:]] != phases[order[:-1]]) | \
+        (lengths[order[1:]] != lengths[order[:-1]])
+    kept = order[first]
+    return events[kept], owners[kept]
+
+
+def coalesce_intervals(intervals):
+    """
+    Merges overlapping intervals (touching ones are kept apart, as the intersection engines expect).
+    :param intervals: np.array of shape (N,2), sorted by start.
+    :return: np.array of shape (M,2), M <= N, of non overlapping intervals sorted by start.
     """
-    url_query = "https://api.dispos.pocot.fr/events/"+str(player_id)+"?from="+str(start_time) +"&to="+str(end_time)
-    json = bdd_handler.query_bdd_for_player(url_query)
-    print(url_query)
-    return json
+    starts, ends, _ = _coalesce_players_intervals(intervals[:, 0], intervals[:, 1],
+                                                  np.zeros(intervals.shape[0], dtype=np.int64))
+    return np.column_stack((starts, ends))
+
+
+def _coalesce_players_intervals(starts, ends, owners):
+    """
+    Counterpart of coalesce_intervals for the intervals of several players at once: intervals of a player are merged
+    together, never with those of other players.
+    :param owners: index of the player of every interval. Intervals must be sorted by player, then by start.
+    :return: starts, ends and owners of merged intervals.
+    """
+    n_intervals = starts.shape[0]
+    if n_intervals < 2:
+        return starts, ends, owners
+    # Running maximum of the ends of every player: ends are shifted by player, so that those of a player are above
+    # those of previous players, and a single accumulation does not carry ends over from a player to the next one.
+    lowest_end = ends.min()
+    shift = ends.max() - lowest_end + 1
+    running_ends = np.maximum.accumulate(ends - lowest_end + owners * shift) - owners * shift + lowest_end
+    new_groups = np.ones(n_intervals, dtype=bool)
+    new_groups[1:] = (owners[1:] != owners[:-1]) | (starts[1:] >= running_ends[:-1])
+    group_starts = np.flatnonzero(new_groups)
+    if group_starts.shape[0] == n_intervals:
+        return starts, ends, owners
+    group_ends = np.concatenate((group_starts[1:], [n_intervals])) - 1
+    return starts[group_starts], running_ends[group_ends], owners[group_starts]
 
 
 def convert_player_json(player_id, start_time, start_time_strict, end_time):
@@ -155,33 +1034,124 @@ def convert_player_json(player_id, start_time, start_time_strict, end_time):
     increasing order.
     """
     player_json = get_player_json(player_id, start_time, end_time)
-    player_array = None
+    with metrics.timer('parse'):
+        return parse_player_json(player_json, start_time_strict, end_time)
 
-    # Expression is equivalent to if player_json != []
-    if player_json:
-        player_df = pd.DataFrame(player_json)
-        try:
-            player_array_tmp = player_df[['start', 'end']]
-        except KeyError:
-            raise KeyError('Player entries invalid: expected to find at start and end keys, but got {} instead'.format(player_df.keys()))
 
-        # We filter out all entries where the start time is out of bound. We do not filter on the end time, because it
-        # is possible that an interval reaches out of these bounds. In such case, we will simply have to truncate it,
-        # instead of excluding it.
-        # Likewise for the case of an entry with a start somehow before start_time.
-        player_array_tmp = player_array_tmp[(player_array_tmp['end'] > start_time_strict) & (player_array_tmp['start'] < end_time)]
+async def convert_player_json_async(player_id, start_time, start_time_strict, end_time):
+    """
+    Non blocking counterpart of convert_player_json, to be used from the bot's event loop.
+    """
+    player_json = await get_player_json_async(player_id, start_time, end_time)
+    with metrics.timer('parse'):
+        return parse_player_json(player_json, start_time_strict, end_time)
+
 
-        # Truncate now the end time of valid entries.
-        player_array = player_array_tmp.copy()
-        player_array.loc[player_array_tmp.end > end_time, 'end'] = end_time
-        player_array.loc[player_array_tmp.start < start_time_strict, 'start'] = start_time_strict
-        player_array = player_array.sort_values('start').to_numpy()
-    return player_array
+def parse_players_json(players_json, start_time_strict, end_time, fetched_until=None):
+    """
+    Converts the JSON (or events arrays) of several players, see parse_player_json. Events of all players are
+    processed together, as a single array, rather than player after player.
+    :return: IntervalTable of the intervals of players, those who did not fill their availabilities being flagged as
+    not valid.
+    """
+    players_events = [player_json if isinstance(player_json, np.ndarray) else events_to_array(player_json)
+                      for player_json in players_json]
+    n_players = len(players_events)
+    counts = np.array([player_events.shape[0] for player_events in players_events], dtype=np.int64)
+    events = np.concatenate(players_events) if n_players != 0 else np.empty((0, 3), dtype=np.int64)
+    owners = np.repeat(np.arange(n_players), counts)
+
+    starts = events[:, 0]
+    ends = events[:, 1]
+    if fetched_until is not None and fetched_until < end_time:
+        repeatable = events[:, 2] != 0
+        patterns, pattern_owners = _get_repeatable_patterns(events[repeatable, :2], owners[repeatable], REPEAT_PERIOD)
+        occurrences, pattern_ids = _expand_repeatable_events(patterns, max(start_time_strict, fetched_until), end_time,
+                                                             REPEAT_PERIOD)
+        # Occurrences starting before fetched_until were returned by the BDD, if they were not deleted.
+        expanded = occurrences[:, 0] >= fetched_until
+        starts = np.concatenate((starts, occurrences[expanded, 0]))
+        ends = np.concatenate((ends, occurrences[expanded, 1]))
+        owners = np.concatenate((owners, pattern_owners[pattern_ids[expanded]]))
+
+    # We filter out all entries where the start time is out of bound. We do not filter on the end time, because it
+    # is possible that an interval reaches out of these bounds. In such case, we will simply have to truncate it,
+    # instead of excluding it.
+    # Likewise for the case of an entry with a start somehow before start_time.
+    kept = (ends > start_time_strict) & (starts < end_time)
+
+    # Truncate now the start and end time of valid entries.
+    starts = np.clip(starts[kept], start_time_strict, end_time)
+    ends = np.clip(ends[kept], start_time_strict, end_time)
+    owners = owners[kept]
+    order = np.lexsort((starts, owners))
+    starts, ends, owners = _coalesce_players_intervals(starts[order], ends[order], owners[order])
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(owners, minlength=n_players))))
+    return IntervalTable(starts, ends, offsets, counts > 0)
+
+
+async def convert_players_json(player_ids, start_time, start_time_strict, end_time):
+    """
+    Fetches and converts the JSON of several players concurrently (the number of queries in flight is bounded by
+    bdd_handler.MAX_CONCURRENT_REQUESTS). See convert_player_json for the meaning of arguments.
+    Once all JSON are fetched, they are parsed together, in the worker pool if they hold enough events (see
+    workers.run_cpu_bound).
+    :return: IntervalTable of players, in the order of player_ids (see parse_players_json).
+    """
+    players_json = await asyncio.gather(*[get_player_json_async(player_id, start_time, end_time)
+                                          for player_id in player_ids])
+    n_events = sum(len(player_json) for player_json in players_json)
+    with metrics.timer('parse'):
+        return await workers.run_cpu_bound(n_events, parse_players_json, players_json, start_time_strict, end_time)
+
+
+async def fetch_players_json(player_ids, start_time, end_time, timeout=None, on_progress=None):
+    """
+    Fetches the events of several players concurrently (see get_player_json_async), giving up on players whose
+    events are not fetched within timeout seconds, or whose queries failed (after retries, see bdd_handler).
+    Queries given up on keep running in the background, and fill the cache for later polls.
+
+    :param timeout: float
+    Time (in seconds) after which to give up on players not fetched yet. None waits for all of them.
+    :param on_progress: coroutine function
+    Called with the list of events of players fetched so far (None for the others) every time queries complete and
+    others are still running, so that callers can report partial results.
+    :return: (players_json, failed_indices): events of every player (None for players given up on), and the indices of
+    players given up on.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    tasks = [asyncio.ensure_future(get_player_json_async(player_id, start_time, end_time)) for player_id in player_ids]
+    indices = {task: i for i, task in enumerate(tasks)}
+    players_json = [None] * len(tasks)
+    failed_indices = []
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    players_json[indices[task]] = task.result()
+                else:
+                    failed_indices.append(indices[task])
+            if done and pending and on_progress is not None:
+                await on_progress(players_json)
+    finally:
+        for task in pending:
+            task.cancel()
+    if pending:
+        metrics.increment('fetch_timeouts', len(pending))
+        logger.warning('Gave up on %s players after %s seconds', len(pending), timeout)
+    failed_indices.extend(indices[task] for task in pending)
+    return players_json, sorted(failed_indices)
 
 
 def convert_time_string_to_unix_timestamp(time_string):
     """Format assumed to be HH:MM"""
-    print('time_string : {}'.format(time_string))
+    logger.debug('time_string : %s', time_string)
     hours_minutes = time_string.split(':')
     hours_minutes[0] = int(hours_minutes[0])
     hours_minutes[1] = int(hours_minutes[1])
@@ -191,10 +1161,56 @@ def convert_time_string_to_unix_timestamp(time_string):
         raise ValueError('Hours should be positive or zero ! ')
     if hours_minutes[1] < 0:
         raise ValueError('Minutes should be positive or zero !')
-    print('New minimum length : {}'.format(hours_minutes[0]*3600 + hours_minutes[1]*60))
+    logger.debug('New minimum length : %s', hours_minutes[0]*3600 + hours_minutes[1]*60)
     return hours_minutes[0]*3600 + hours_minutes[1]*60
 
 
+def convert_durations_string_to_lengths(durations_string, step='00:30', max_durations=24):
+    """
+    Converts durations, given as HH:MM (a single one), HH:MM,HH:MM,... (several ones), or HH:MM-HH:MM (a range, by
+    steps of step, or HH:MM-HH:MM/HH:MM to give the step), to minimum lengths in milliseconds.
+    :return: list of distinct, strictly positive lengths, the longest first.
+    """
+    try:
+        if '-' in durations_string:
+            bounds, _, range_step = durations_string.partition('/')
+            first, last = bounds.split('-')
+            first, last, step = (convert_time_string_to_unix_timestamp(duration)
+                                 for duration in (first, last, range_step or step))
+            if step <= 0:
+                raise ValueError('Step of a range of durations should be strictly positive!')
+            lengths = list(range(min(first, last), max(first, last) + 1, step))
+        else:
+            lengths = [convert_time_string_to_unix_timestamp(duration) for duration in durations_string.split(',')]
+    except (ValueError, IndexError):
+        raise ValueError('Durations should conform to HH:MM, HH:MM,HH:MM,... or HH:MM-HH:MM[/HH:MM], got {} '
+                         'instead.'.format(durations_string))
+    if min(lengths) <= 0:
+        raise ValueError('Durations should be strictly positive!')
+    if len(set(lengths)) > max_durations:
+        raise ValueError('At most {} durations can be asked for at once.'.format(max_durations))
+    return sorted({length * 1000 for length in lengths}, reverse=True)
+
+
+def convert_quorum_string_to_count(quorum_string, n_players):
+    """
+    Converts a quorum, given either as a number of players (e.g. 5) or as a percentage of n_players (e.g. 60%), to a
+    number of players. Percentages are rounded up.
+    """
+    try:
+        if quorum_string.endswith('%'):
+            percentage = float(quorum_string[:-1])
+            if percentage <= 0 or percentage > 100:
+                raise ValueError('Quorum percentage should be strictly positive and at most 100!')
+            return max(int(np.ceil(percentage * n_players / 100 - 1e-9)), 1)
+        quorum = int(quorum_string)
+    except ValueError:
+        raise ValueError('Quorum should be a strictly positive integer or a percentage, got {} instead.'.format(quorum_string))
+    if quorum <= 0:
+        raise ValueError('Quorum should be strictly positive!')
+    return quorum
+
+
 def convert_weeks_to_unix_timestamp(n_weeks: int):
     if n_weeks <= 0:
         raise ValueError('Should look at at least one week, but number of weeks was negative or null.')
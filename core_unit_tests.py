@@ -1,9 +1,26 @@
 import unittest
+import asyncio
+import core
 from core import *
 from unittest import mock
-from bdd_handler_mock import query_bdd_for_player_mock
+from bdd_handler_mock import query_bdd_for_player_mock, query_bdd_for_player_async_mock, generate_player_json, WEEK
+from bdd_server_mock import MockBddServer
+from availability_cache import AvailabilityCache
+from snapshot_store import SnapshotStore
+from interval_table import IntervalTable
+from prefetch import PrefetchScheduler
+from group_index import GroupIntersectionIndex, GroupIndexCache
+import prefetch
+from metrics import Metrics, Histogram
+import metrics
+import threading
+import workers
+import bdd_handler
 
 class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        player_cache.clear()
+
     @mock.patch('bdd_handler.query_bdd_for_player', side_effect=query_bdd_for_player_mock)
     def test_something(self, query_bdd_function):
         array_p_1 = np.asarray([[0, 100000], [200000, 500000], [700000, 1100000]])
@@ -15,14 +32,786 @@ class MyTestCase(unittest.TestCase):
 
         print(find_intersections([array_p_1], minimum_length=4))
 
-        player_0_data = convert_player_json(188626510901542912, 0, 0, 90000)
-        player_1_data = convert_player_json(265523588918935552, 0, 0, 90000)
-        player_2_data = convert_player_json(298673420181438465, 0, 0, 90000)
+        player_0_data = convert_player_json(188626510901542912, 0, 0, 1100000)
+        player_1_data = convert_player_json(265523588918935552, 0, 0, 1100000)
+        player_2_data = convert_player_json(298673420181438465, 0, 0, 1100000)
 
         assert (np.all(player_0_data == array_p_1))
         assert (np.all(player_1_data == array_p_2))
         assert (np.all(player_2_data == array_p_3))
 
 
+def generate_random_calendar(random_state, max_intervals, horizon):
+    """
+    Generates sorted, non overlapping (but possibly touching) intervals, as returned by convert_player_json.
+    """
+    n_bounds = 2 * random_state.randint(0, max_intervals + 1)
+    bounds = np.sort(random_state.choice(horizon, size=n_bounds, replace=False))
+    calendar = bounds.reshape(-1, 2)
+    # Make some intervals touch their successor, to check that they are not merged.
+    touching = random_state.rand(max(calendar.shape[0] - 1, 0)) < 0.2
+    calendar[:-1, 1][touching] = calendar[1:, 0][touching]
+    return calendar
+
+
+class FindIntersectionsTestCase(unittest.TestCase):
+    def test_sweep_matches_reference_on_random_calendars(self):
+        random_state = np.random.RandomState(0)
+        for _ in range(300):
+            n_players = random_state.randint(1, 8)
+            calendars = [generate_random_calendar(random_state, 10, 1000) for _ in range(n_players)]
+            # Reference cannot deal with players with no interval, the sweep treats them as never available.
+            calendars = [calendar for calendar in calendars if calendar.shape[0] > 0]
+            if len(calendars) == 0:
+                continue
+            minimum_length = random_state.randint(1, 50)
+            expected = find_intersections_reference(calendars, minimum_length)
+            self.assertEqual(find_intersections(calendars, minimum_length), expected)
+
+    def test_lazy_variants_match_sweep_on_random_calendars(self):
+        random_state = np.random.RandomState(1)
+        for _ in range(300):
+            n_players = random_state.randint(1, 8)
+            calendars = [generate_random_calendar(random_state, 30, 10000) for _ in range(n_players)]
+            minimum_length = random_state.randint(1, 200)
+            expected = find_intersections(calendars, minimum_length)
+            self.assertEqual(list(iter_intersections(calendars, minimum_length)), expected)
+            self.assertEqual(find_first_intersection(calendars, minimum_length), expected[0] if expected else None)
+            self.assertEqual(find_top_intersections(calendars, minimum_length, 3, longest=False), expected[:3])
+            longest = sorted(expected, key=lambda interval: (interval[1] - interval[0], -interval[0]), reverse=True)
+            self.assertEqual(find_top_intersections(calendars, minimum_length, 3), longest[:3])
+
+    def test_first_intersection_does_not_sweep_whole_calendars(self):
+        n_intervals = 10000
+        starts = np.arange(n_intervals) * 100
+        calendar = np.column_stack((starts, starts + 50))
+        with mock.patch('core._sweep_intersections', wraps=core._sweep_intersections) as sweep:
+            self.assertEqual(find_first_intersection([calendar, calendar], minimum_length=10), [0, 50])
+        self.assertLess(max(call.args[0].shape[0] for call in sweep.call_args_list), 2 * n_intervals / 100)
+
+    def test_top_intersections_invalid_k(self):
+        with self.assertRaises(ValueError):
+            find_top_intersections([np.asarray([[0, 10]])], minimum_length=1, k=0)
+
+    def test_full_quorum_matches_sweep_on_random_calendars(self):
+        random_state = np.random.RandomState(2)
+        for _ in range(200):
+            n_players = random_state.randint(1, 8)
+            calendars = [generate_random_calendar(random_state, 10, 1000) for _ in range(n_players)]
+            minimum_length = random_state.randint(1, 50)
+            found = find_quorum_intersections(calendars, minimum_length, n_players)
+            self.assertEqual([interval for interval, _ in found], find_intersections(calendars, minimum_length))
+            self.assertTrue(all(missing == [] for _, missing in found))
+
+    def test_quorum_matches_brute_force_on_random_calendars(self):
+        random_state = np.random.RandomState(3)
+        for _ in range(200):
+            n_players = random_state.randint(1, 6)
+            calendars = [generate_random_calendar(random_state, 5, 200) for _ in range(n_players)]
+            minimum_length = random_state.randint(1, 30)
+            quorum = random_state.randint(1, n_players + 1)
+            bounds = np.unique(np.concatenate(calendars, axis=None))
+            valid = {}
+            for a in bounds:
+                for b in bounds[bounds >= a + minimum_length]:
+                    present = [i for i, calendar in enumerate(calendars)
+                               if np.any((calendar[:, 0] <= a) & (calendar[:, 1] >= b))]
+                    if len(present) >= quorum:
+                        valid[(a, b)] = [i for i in range(n_players) if i not in present]
+            expected = [([float(a), float(b)], valid[(a, b)]) for (a, b) in sorted(valid)
+                        if not any(c <= a and b <= d and (c, d) != (a, b) for (c, d) in valid)]
+            self.assertEqual(find_quorum_intersections(calendars, minimum_length, quorum), expected)
+
+    def test_quorum_reports_missing_players(self):
+        array_p_1 = np.asarray([[0, 100], [200, 500]])
+        array_p_2 = np.asarray([[0, 90], [150, 310]])
+        array_p_3 = np.asarray([[50, 400]])
+        found = find_quorum_intersections([array_p_1, None, array_p_2, array_p_3], 50, 2)
+        self.assertEqual(found, [([0.0, 90.0], [3]), ([50.0, 100.0], [2]), ([150.0, 310.0], [0]),
+                                 ([200.0, 400.0], [2])])
+        with self.assertRaises(ValueError):
+            find_quorum_intersections([array_p_1, None, array_p_2], 50, 3)
+
+    def test_best_intersections_match_searches_per_length(self):
+        random_state = np.random.RandomState(4)
+        for _ in range(100):
+            n_players = random_state.randint(1, 6)
+            calendars = [generate_random_calendar(random_state, 20, 10000) for _ in range(n_players)]
+            minimum_lengths = sorted(random_state.randint(1, 500, size=3).tolist())
+            k = random_state.randint(1, 4)
+            for longest in (False, True):
+                best = find_best_intersections(calendars, minimum_lengths, k=k, longest=longest)
+                for minimum_length in minimum_lengths:
+                    expected = find_top_intersections(calendars, minimum_length, k, longest=longest)
+                    self.assertEqual(best[minimum_length], [(interval, []) for interval in expected])
+            quorum = random_state.randint(1, n_players + 1)
+            best = find_best_intersections(calendars, minimum_lengths, k=k, quorum=quorum)
+            for minimum_length in minimum_lengths:
+                expected = find_quorum_intersections(calendars, minimum_length, quorum)[:k]
+                self.assertEqual(best[minimum_length], [(interval, missing) for interval, missing in expected])
+
+    def test_durations_strings(self):
+        self.assertEqual(convert_durations_string_to_lengths('02:00'), [7200000])
+        self.assertEqual(convert_durations_string_to_lengths('01:30,03:00,01:30'), [10800000, 5400000])
+        self.assertEqual(convert_durations_string_to_lengths('01:00-02:00'), [7200000, 5400000, 3600000])
+        self.assertEqual(convert_durations_string_to_lengths('01:00-02:00/00:20'),
+                         [7200000, 6000000, 4800000, 3600000])
+        for durations_string in ['01:00-', '00:00', 'abc', '01:00-02:00/00:00', '00:30-23:30']:
+            with self.assertRaises(ValueError):
+                convert_durations_string_to_lengths(durations_string)
+
+    def test_quorum_strings(self):
+        self.assertEqual(convert_quorum_string_to_count('5', 10), 5)
+        self.assertEqual(convert_quorum_string_to_count('60%', 10), 6)
+        self.assertEqual(convert_quorum_string_to_count('50%', 5), 3)
+        self.assertEqual(convert_quorum_string_to_count('1%', 5), 1)
+        for quorum_string in ['0', '-2', 'abc', '0%', '150%', '%']:
+            with self.assertRaises(ValueError):
+                convert_quorum_string_to_count(quorum_string, 10)
+
+    def test_grid_matches_sweep_up_to_resolution(self):
+        random_state = np.random.RandomState(4)
+        resolution = 10
+        for _ in range(200):
+            n_players = random_state.randint(1, 8)
+            calendars = [generate_random_calendar(random_state, 10, 3000) for _ in range(n_players)]
+            minimum_length = random_state.randint(1, 100)
+            # Touching intervals are merged by the grid, so they are merged in exact intervals too.
+            exact = []
+            for interval in find_intersections(calendars, 1):
+                if exact and exact[-1][1] == interval[0]:
+                    exact[-1][1] = interval[1]
+                else:
+                    exact.append(interval)
+            found = find_intersections_grid(calendars, minimum_length, resolution=resolution)
+            for interval in found:
+                self.assertGreaterEqual(interval[1] - interval[0], minimum_length)
+                self.assertTrue(any(start <= interval[0] and interval[1] <= end for start, end in exact))
+            for start, end in exact:
+                if end - start >= minimum_length + 2 * resolution:
+                    self.assertTrue(any(0 <= interval[0] - start < resolution and 0 <= end - interval[1] < resolution
+                                        for interval in found))
+
+    def test_grid_counts(self):
+        array_p_1 = np.asarray([[0, 100], [200, 500]])
+        array_p_2 = np.asarray([[0, 90], [150, 310]])
+        origin, counts = count_available_grid([array_p_1, None, array_p_2], resolution=50)
+        self.assertEqual(origin, 0)
+        self.assertEqual(counts.tolist(), [2, 1, 0, 1, 2, 2, 1, 1, 1, 1])
+
+    def test_engine_choice(self):
+        calendar = np.asarray([[0, 10 * GRID_RESOLUTION]])
+        self.assertEqual(choose_engine([calendar] * 10), 'sweep')
+        self.assertEqual(choose_engine([calendar] * GRID_MIN_PLAYERS), 'grid')
+        long_calendar = np.asarray([[0, (GRID_MAX_CELLS + 1) * GRID_RESOLUTION]])
+        self.assertEqual(choose_engine([long_calendar] * GRID_MIN_PLAYERS), 'sweep')
+        self.assertEqual(find_first_intersection([calendar] * GRID_MIN_PLAYERS, GRID_RESOLUTION, engine='auto'),
+                         [0, 10 * GRID_RESOLUTION])
+
+    def test_touching_intervals_are_not_merged(self):
+        array_p_1 = np.asarray([[0, 10], [10, 20]])
+        array_p_2 = np.asarray([[0, 20]])
+        self.assertEqual(find_intersections([array_p_1, array_p_2], minimum_length=1), [[0, 10], [10, 20]])
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            find_intersections([], minimum_length=1)
+        with self.assertRaises(ValueError):
+            find_intersections([np.asarray([[0, 10]])], minimum_length=0)
+        with self.assertRaises(ValueError):
+            find_intersections([None, None], minimum_length=1)
+        with self.assertRaises(ValueError):
+            find_intersections([np.asarray([0, 10])], minimum_length=1)
+
+    def test_players_without_availabilities_are_ignored(self):
+        array_p_1 = np.asarray([[0, 100000], [200000, 500000]])
+        self.assertEqual(find_intersections([None, array_p_1], minimum_length=4), [[0, 100000], [200000, 500000]])
+
+
+class ParsePlayerJsonTestCase(unittest.TestCase):
+    def test_intervals_are_filtered_truncated_and_sorted(self):
+        player_json = [{'start': 700, 'end': 1100, 'repeatable': 0, 'id': 'some-id'},
+                       {'start': 0, 'end': 100, 'repeatable': 0, 'id': 'some-id'},
+                       {'start': 200, 'end': 500, 'repeatable': 0, 'id': 'some-id'},
+                       {'start': 1200, 'end': 1300, 'repeatable': 0, 'id': 'some-id'}]
+        player_array = parse_player_json(player_json, 50, 1000)
+        self.assertEqual(player_array.dtype, np.int64)
+        self.assertEqual(player_array.tolist(), [[50, 100], [200, 500], [700, 1000]])
+
+    def test_no_interval_in_window(self):
+        player_array = parse_player_json([{'start': 0, 'end': 100}], 200, 1000)
+        self.assertEqual(player_array.shape, (0, 2))
+
+    def test_empty_json(self):
+        self.assertIsNone(parse_player_json([], 0, 1000))
+        self.assertIsNone(parse_player_json('', 0, 1000))
+
+    def test_repeatable_events_are_expanded_and_coalesced(self):
+        week = 7 * 24 * 3600 * 1000
+        player_json = [{'start': 100, 'end': 200, 'repeatable': 1, 'id': 'weekly'},
+                       {'start': week + 150, 'end': week + 300, 'repeatable': 0, 'id': 'one-off'},
+                       {'start': week + 100, 'end': week + 200, 'repeatable': 1, 'id': 'weekly'},
+                       {'start': 3 * week - 50, 'end': 3 * week + 50, 'repeatable': 1, 'id': 'late'}]
+        # Events were fetched up to 3 weeks: the occurrence of the second week of 'weekly' was deleted.
+        player_array = parse_player_json(player_json, 150, 4 * week - 100, fetched_until=3 * week)
+        self.assertEqual(player_array.tolist(), [[150, 200], [week + 100, week + 300], [3 * week - 50, 3 * week + 50],
+                                                 [3 * week + 100, 3 * week + 200]])
+
+    def test_occurrences_returned_by_the_bdd_are_taken_as_is(self):
+        week = 7 * 24 * 3600 * 1000
+        hour = 3600 * 1000
+        # Weekly event from 20:00 to 22:00, deleted on the second week and moved one hour earlier on the third one.
+        player_json = [{'start': 20 * hour, 'end': 22 * hour, 'repeatable': 1},
+                       {'start': 2 * week + 19 * hour, 'end': 2 * week + 21 * hour, 'repeatable': 1}]
+        player_array = parse_player_json(player_json, 0, 3 * week)
+        self.assertEqual((player_array // hour).tolist(), [[20, 22], [355, 357]])
+
+    def test_occurrences_of_repeatable_events_are_expanded_once(self):
+        week = 7 * 24 * 3600 * 1000
+        occurrences = [{'start': k * week + 100, 'end': k * week + 200, 'repeatable': 1} for k in range(4)]
+        # Same time within the week, but another length: another pattern.
+        occurrences.append({'start': 2 * week + 100, 'end': 2 * week + 250, 'repeatable': 1})
+        players_json = [occurrences, occurrences[:1] + occurrences[3:]]
+        with mock.patch('core._expand_repeatable_events', wraps=core._expand_repeatable_events) as expand:
+            table = parse_players_json(players_json, 0, 8 * week, fetched_until=4 * week)
+        self.assertEqual(expand.call_args.args[0].tolist(), [[100, 200], [2 * week + 100, 2 * week + 250],
+                                                             [100, 200], [2 * week + 100, 2 * week + 250]])
+        # Only the third week holds an occurrence of the second pattern before 4 weeks.
+        expected = [[k * week + 100, k * week + (250 if k == 2 or k >= 4 else 200)] for k in range(8)]
+        self.assertEqual(table[0].tolist(), expected)
+        # The occurrence of the second week of the second player is deleted.
+        self.assertEqual(table[1].tolist(), expected[:1] + expected[2:])
+
+    def test_expansion_matches_naive_loop(self):
+        random_state = np.random.RandomState(5)
+        period = 1000
+        patterns = np.sort(random_state.randint(0, 3000, size=(20, 2)), axis=1)
+        patterns[:, 1] += 1
+        start_time_strict, end_time = 1500, 7300
+        expected = [[start + k * period, end + k * period] for start, end in patterns.tolist() for k in range(10)
+                    if end + k * period > start_time_strict and start + k * period < end_time]
+        self.assertEqual(expand_repeatable_events(patterns, start_time_strict, end_time, period=period).tolist(),
+                         expected)
+
+    def test_coalesce_intervals(self):
+        intervals = np.asarray([[0, 10], [5, 8], [8, 20], [20, 30], [40, 50], [45, 60]])
+        self.assertEqual(coalesce_intervals(intervals).tolist(), [[0, 20], [20, 30], [40, 60]])
+
+    def test_malformed_entries(self):
+        with self.assertRaises(KeyError):
+            parse_player_json([{'start': 0, 'end': 100}, {'begin': 0, 'end': 100}], 0, 1000)
+
+    def test_synthetic_calendars(self):
+        random_state = np.random.RandomState(0)
+        player_json = generate_player_json(random_state, 0, 2, 50, overlap_density=0.3)
+        player_array = parse_player_json(player_json, 0, 2 * WEEK)
+        self.assertEqual(player_array.shape, (50, 2))
+        self.assertTrue(np.all(player_array[1:, 0] >= player_array[:-1, 1]))
+        self.assertAlmostEqual(np.sum(player_array[:, 1] - player_array[:, 0]) / (2 * WEEK), 0.3, places=3)
+
+    def test_players_are_parsed_together(self):
+        random_state = np.random.RandomState(2)
+        players_json = [generate_player_json(random_state, 0, 2, 20, overlap_density=0.5, repeatable_ratio=0.3)
+                        for _ in range(10)] + [[]]
+        table = parse_players_json(players_json, WEEK // 3, 2 * WEEK)
+        self.assertEqual(table.valid.tolist(), [True] * 10 + [False])
+        for player_json, player_array in zip(players_json, table):
+            if player_json:
+                expected = parse_players_json([player_json], WEEK // 3, 2 * WEEK)[0]
+                self.assertEqual(player_array.tolist(), expected.tolist())
+            else:
+                self.assertIsNone(player_array)
+
+
+class IntervalTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.arrays = [np.array([[0, 10], [20, 30]]), None, np.empty((0, 2), dtype=np.int64), np.array([[5, 25]])]
+        self.table = IntervalTable.from_arrays(self.arrays)
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.table), 4)
+        self.assertEqual(self.table.offsets.tolist(), [0, 2, 2, 2, 3])
+        self.assertEqual(self.table.starts.dtype, np.int64)
+        for array, player_array in zip(self.arrays, self.table):
+            if array is None:
+                self.assertIsNone(player_array)
+            else:
+                self.assertEqual(player_array.tolist(), array.tolist())
+
+    def test_select(self):
+        table = self.table.select([3, 0])
+        self.assertEqual(table.offsets.tolist(), [0, 1, 3])
+        self.assertEqual(table.starts.tolist(), [5, 0, 20])
+        self.assertEqual(table.owners().tolist(), [0, 1, 1])
+
+    def test_engines_accept_tables_and_return_ints(self):
+        table = self.table.select([0, 3])
+        found = find_intersections(table, 1)
+        self.assertEqual(found, [[5, 10], [20, 25]])
+        self.assertIsInstance(found[0][0], int)
+        self.assertEqual(find_first_intersection(table, 1), [5, 10])
+        self.assertEqual(find_intersections_grid(table, 1, resolution=5), [[5, 10], [20, 25]])
+        interval, missing = find_first_quorum_intersection(self.table, 1, 1)
+        self.assertEqual((interval, missing), ([0, 10], [2, 3]))
+        self.assertIsInstance(interval[0], int)
+
+
+class ConvertPlayersJsonTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        player_cache.clear()
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_players_are_returned_in_order(self, query_bdd_function):
+        players_data = await convert_players_json([265523588918935552, 1, 188626510901542912], 0, 0, 1100000)
+        self.assertEqual(query_bdd_function.call_count, 3)
+        self.assertTrue(np.all(players_data[0] == np.asarray([[3, 90000], [150000, 310000]])))
+        self.assertIsNone(players_data[1])
+        self.assertTrue(np.all(players_data[2] == np.asarray([[0, 100000], [200000, 500000], [700000, 1100000]])))
+
+    async def test_fetch_from_local_server(self):
+        with MockBddServer() as server:
+            with mock.patch('core.BDD_URL', server.url):
+                try:
+                    players_data = await convert_players_json(['298673420181438465'] * 5, 0, 0, 1100000)
+                finally:
+                    await bdd_handler.close_session()
+            # Concurrent fetches of the same player share a single query.
+            self.assertEqual(server.n_requests, 1)
+        for player_data in players_data:
+            self.assertTrue(np.all(player_data == np.asarray([[2, 80000], [170000, 700000]])))
+
+    async def test_failed_queries_are_retried(self):
+        n_calls = []
+
+        def events_provider(player_id, start_time, end_time):
+            n_calls.append(player_id)
+            if len(n_calls) == 1:
+                raise RuntimeError('API failure')
+            return [{'start': 0, 'end': 100}]
+
+        with MockBddServer(events_provider=events_provider) as server:
+            with mock.patch('core.BDD_URL', server.url), mock.patch('bdd_handler.RETRY_BACKOFF', 0):
+                try:
+                    players_json, failed_indices = await fetch_players_json(['1'], 0, 1000)
+                finally:
+                    await bdd_handler.close_session()
+            self.assertEqual(server.n_requests, 2)
+        self.assertEqual(players_json[0].tolist(), [[0, 100, 0]])
+        self.assertEqual(failed_indices, [])
+
+    async def test_slow_players_are_given_up_on(self):
+        def events_provider(player_id, start_time, end_time):
+            if player_id == '1':
+                time.sleep(1)
+            return [{'start': 0, 'end': 100}]
+
+        progress = []
+
+        async def on_progress(players_json):
+            progress.append([player_json is not None for player_json in players_json])
+
+        with MockBddServer(events_provider=events_provider) as server:
+            with mock.patch('core.BDD_URL', server.url):
+                try:
+                    players_json, failed_indices = await fetch_players_json(['1', '2'], 0, 1000, timeout=0.3,
+                                                                            on_progress=on_progress)
+                finally:
+                    await bdd_handler.close_session()
+        self.assertIsNone(players_json[0])
+        self.assertEqual(failed_indices, [0])
+        self.assertEqual(progress, [[False, True]])
+
+
+class AvailabilityCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = AvailabilityCache(ttl=10, max_events=5, clock=lambda: self.now)
+        self.events = [{'start': 0, 'end': 100}, {'start': 200, 'end': 500}, {'start': 700, 'end': 1100}]
+
+    def test_wider_window_answers_narrower_requests(self):
+        self.assertIsNone(self.cache.get(1, 0, 1100))
+        self.cache.put(1, 0, 1100, self.events)
+        self.assertEqual(self.cache.get('1', 0, 1100), self.events)
+        self.assertEqual(self.cache.get(1, 150, 600), [{'start': 200, 'end': 500}])
+        self.assertIsNone(self.cache.get(1, 0, 2000))
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_entries_expire(self):
+        self.cache.put(1, 0, 1100, self.events)
+        self.now = 11.0
+        self.assertIsNone(self.cache.get(1, 0, 1100))
+        self.assertEqual(self.cache.stats()['events'], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.put(1, 0, 1100, self.events)
+        self.cache.put(2, 0, 1100, self.events[:1])
+        self.cache.get(1, 0, 1100)
+        self.cache.put(3, 0, 1100, self.events[:2])
+        self.assertIsNone(self.cache.get(2, 0, 1100))
+        self.assertIsNotNone(self.cache.get(1, 0, 1100))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertEqual(self.cache.stats()['events'], 5)
+
+    def test_repeatable_events_are_kept_when_slicing(self):
+        events = self.events + [{'start': 10, 'end': 20, 'repeatable': 1}]
+        self.cache.put(1, 0, 1100, events)
+        self.assertEqual(self.cache.get(1, 150, 600),
+                         [{'start': 200, 'end': 500}, {'start': 10, 'end': 20, 'repeatable': 1}])
+
+    def test_empty_calendars_are_cached(self):
+        self.cache.put(1, 0, 1100, [])
+        self.assertEqual(self.cache.get(1, 0, 100), [])
+
+    @mock.patch('bdd_handler.query_bdd_for_player', side_effect=query_bdd_for_player_mock)
+    def test_get_player_json_uses_cache(self, query_bdd_function):
+        player_cache.clear()
+        get_player_json(188626510901542912, 0, 1100000)
+        player_json = get_player_json(188626510901542912, 0, 90000)
+        self.assertEqual(query_bdd_function.call_count, 1)
+        np.testing.assert_array_equal(player_json, [[0, 100000, 1]])
+
+
+class SnapshotStoreTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        player_cache.clear()
+        self.store = SnapshotStore(':memory:')
+        patcher = mock.patch('core.snapshot_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.store.close)
+        self.addCleanup(player_cache.clear)
+        self.addCleanup(core._pending_snapshots.clear)
+        core._restored_players.clear()
+        self.addCleanup(core._restored_players.clear)
+
+    def test_round_trip(self):
+        events = np.array([[0, 10, 0], [20, 30, 1]], dtype=np.int64)
+        self.store.put(1, 0, 100, events, fetched_at=5.0)
+        stored_events, fetched_at = self.store.get(1, 10, 90)
+        np.testing.assert_array_equal(stored_events, events)
+        self.assertEqual(fetched_at, 5.0)
+        self.assertIsNone(self.store.get(1, 0, 200))
+        self.assertIsNone(self.store.get(2, 0, 100))
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_fresh_snapshot_spares_query(self, query_bdd_function):
+        self.store.put(188626510901542912, 0, 1100000, np.array([[0, 50, 0], [200, 300, 0]], dtype=np.int64))
+        events = await get_player_json_async(188626510901542912, 100, 1000)
+        np.testing.assert_array_equal(events, [[200, 300, 0]])
+        self.assertEqual(query_bdd_function.call_count, 0)
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_stale_snapshot_is_refreshed_in_background(self, query_bdd_function):
+        stale_events = np.array([[200, 300, 0]], dtype=np.int64)
+        self.store.put(188626510901542912, 0, 1100000, stale_events,
+                       fetched_at=time.time() - core.SNAPSHOT_REFRESH_AGE - 1)
+        events = await get_player_json_async(188626510901542912, 0, 1100000)
+        np.testing.assert_array_equal(events, stale_events)
+        await asyncio.gather(*core._refresh_tasks)
+        self.assertEqual(query_bdd_function.call_count, 1)
+        await core.flush_snapshots()
+        events, _ = self.store.get(188626510901542912, 0, 1100000)
+        np.testing.assert_array_equal(events, events_to_array(query_bdd_for_player_mock('188626510901542912')))
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_stale_snapshots_are_only_returned_after_startup(self, query_bdd_function):
+        stale_events = np.array([[200, 300, 0]], dtype=np.int64)
+        fetched_at = time.time() - core.SNAPSHOT_REFRESH_AGE - 1
+        self.store.put(188626510901542912, 0, 1100000, stale_events, fetched_at=fetched_at)
+        np.testing.assert_array_equal(await get_player_json_async(188626510901542912, 0, 1100000), stale_events)
+        await asyncio.gather(*core._refresh_tasks)
+        # Once the refreshed calendar expired from the cache, a stale snapshot is refreshed before being returned.
+        player_cache.clear()
+        core._pending_snapshots.clear()
+        self.store.put(188626510901542912, 0, 1100000, stale_events, fetched_at=fetched_at)
+        events = await get_player_json_async(188626510901542912, 0, 1100000)
+        np.testing.assert_array_equal(events, events_to_array(query_bdd_for_player_mock('188626510901542912')))
+        self.assertEqual(query_bdd_function.call_count, 2)
+
+    @mock.patch('core.SNAPSHOT_FLUSH_DELAY', 0.05)
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_fetched_calendars_are_stored_in_one_batch(self, query_bdd_function):
+        player_ids = [188626510901542912, 265523588918935552, 298673420181438465]
+        with mock.patch.object(self.store, 'put_many', wraps=self.store.put_many) as put_many, \
+                mock.patch.object(self.store, 'put') as put:
+            await asyncio.gather(*[get_player_json_async(player_id, 0, 1100000) for player_id in player_ids])
+            # Snapshots not written yet are used like stored ones.
+            player_cache.clear()
+            await get_player_json_async(player_ids[0], 0, 1100000)
+            self.assertEqual(query_bdd_function.call_count, 3)
+            self.assertIsNone(self.store.get(player_ids[0], 0, 1100000))
+            await asyncio.sleep(0.2)
+        self.assertEqual(put_many.call_count, 1)
+        self.assertEqual(put.call_count, 0)
+        for player_id in player_ids:
+            events, _ = self.store.get(player_id, 0, 1100000)
+            np.testing.assert_array_equal(events, events_to_array(query_bdd_for_player_mock(str(player_id))))
+
+    @mock.patch('bdd_handler.query_bdd_for_player', side_effect=query_bdd_for_player_mock)
+    def test_expired_snapshot_is_ignored(self, query_bdd_function):
+        self.store.put(188626510901542912, 0, 1100000, np.array([[200, 300, 0]], dtype=np.int64),
+                       fetched_at=time.time() - core.SNAPSHOT_MAX_AGE - 1)
+        np.testing.assert_array_equal(get_player_json(188626510901542912, 0, 1100000),
+                                      events_to_array(query_bdd_for_player_mock('188626510901542912')))
+        self.assertEqual(query_bdd_function.call_count, 1)
+
+
+class PrefetchSchedulerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        player_cache.clear()
+        self.addCleanup(player_cache.clear)
+        self.now = 1600041600.0
+        self.scheduler = PrefetchScheduler(budget=2, lead=240, clock=lambda: self.now)
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_groups_are_prefetched_ahead_of_next_week(self, query_bdd_function):
+        member_ids = [188626510901542912, 265523588918935552, 298673420181438465]
+        self.scheduler.record(member_ids, 1)
+        self.now += 3600
+        self.assertEqual(self.scheduler.get_due_fetches(), [])
+
+        self.now += prefetch.WEEK - 3600 - 100
+        start_time, end_time = prefetch.get_poll_window(self.now + 100, 1)
+        self.assertEqual(sorted(self.scheduler.get_due_fetches()),
+                         sorted((member_id, start_time, end_time) for member_id in member_ids))
+        self.assertEqual(await self.scheduler.prefetch(), 2)
+        self.assertEqual(await self.scheduler.prefetch(), 1)
+        self.assertEqual(await self.scheduler.prefetch(), 0)
+        self.assertEqual(query_bdd_function.call_count, 3)
+
+        self.now += 100
+        self.scheduler.record(member_ids, 1)
+        self.assertEqual(self.scheduler.stats()['hits'], 3)
+        self.assertEqual(self.scheduler.stats()['hit_rate'], 0.5)
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_calendars_expiring_before_the_poll_are_fetched_again(self, query_bdd_function):
+        member_id = 188626510901542912
+        cache = AvailabilityCache(ttl=300, clock=lambda: self.now)
+        self.scheduler.record([member_id], 1)
+        start_time, end_time = prefetch.get_poll_window(self.now + prefetch.WEEK, 1)
+        self.now += prefetch.WEEK - 350
+        with mock.patch('core.player_cache', cache):
+            cache.put(member_id, start_time, end_time, np.empty((0, 3), dtype=np.int64))
+            self.now += 150
+            # Cached 150 seconds ago, the calendar would expire before the poll, due in 200 seconds.
+            self.assertEqual(self.scheduler.get_due_fetches(), [(member_id, start_time, end_time)])
+            self.assertEqual(await self.scheduler.prefetch(), 1)
+            self.assertEqual(query_bdd_function.call_count, 1)
+            self.assertEqual(self.scheduler.get_due_fetches(), [])
+            self.now += 200
+            self.scheduler.record([member_id], 1)
+        self.assertEqual(self.scheduler.stats()['hits'], 1)
+
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_prefetched_calendars_expired_before_the_poll_are_not_hits(self, query_bdd_function):
+        member_id = 188626510901542912
+        cache = AvailabilityCache(ttl=300, clock=lambda: self.now)
+        self.scheduler.record([member_id], 1)
+        self.now += prefetch.WEEK - 200
+        with mock.patch('core.player_cache', cache):
+            self.assertEqual(await self.scheduler.prefetch(), 1)
+            # The poll comes late, once the prefetched calendar expired.
+            self.now += 400
+            self.scheduler.record([member_id], 1)
+        self.assertEqual(self.scheduler.stats()['hits'], 0)
+
+    async def test_busy_scheduler_waits(self):
+        self.scheduler.busy = lambda: True
+        self.scheduler.record([1], 1)
+        self.now += prefetch.WEEK
+        self.assertEqual(await self.scheduler.prefetch(), 0)
+
+    def test_old_groups_are_forgotten(self):
+        self.scheduler.record([1], 1)
+        self.now += prefetch.PREFETCH_GROUP_TTL + 1
+        self.scheduler.get_due_fetches()
+        self.assertEqual(self.scheduler.stats()['groups'], 0)
+
+
+def generate_random_events(random_state, max_events, horizon):
+    """
+    Generates an events array (see events_to_array) of random, possibly overlapping and repeatable, events.
+    """
+    n_events = random_state.randint(0, max_events + 1)
+    starts = random_state.randint(0, horizon, size=n_events)
+    lengths = random_state.randint(1, horizon // 4, size=n_events)
+    repeatable = random_state.rand(n_events) < 0.3
+    return np.column_stack((starts, starts + lengths, repeatable)).astype(np.int64)
+
+
+class GroupIntersectionIndexTestCase(unittest.IsolatedAsyncioTestCase):
+    def test_intersect_calendars_matches_sweep(self):
+        random_state = np.random.RandomState(7)
+        for _ in range(300):
+            first = generate_random_calendar(random_state, 10, 1000)
+            second = generate_random_calendar(random_state, 10, 1000)
+            expected = find_intersection_set([first, second], 1).found
+            self.assertTrue(np.array_equal(intersect_calendars(first, second), expected))
+        self.assertIs(intersect_calendars(first, None), first)
+        self.assertIsNone(intersect_calendars(None, None))
+
+    def test_index_follows_changes_of_the_group(self):
+        random_state = np.random.RandomState(8)
+        start_time, end_time = 0, 2 * REPEAT_PERIOD
+        for _ in range(100):
+            player_ids = list(range(random_state.randint(1, 10)))
+            players_events = [generate_random_events(random_state, 5, REPEAT_PERIOD) for _ in player_ids]
+            index = GroupIntersectionIndex()
+            for _ in range(8):
+                index.update(player_ids, players_events, start_time, end_time)
+                start_time_strict = random_state.randint(0, REPEAT_PERIOD)
+                table = parse_players_json(players_events, start_time_strict, end_time)
+                found = index.intersections(start_time_strict, end_time)
+                if table.valid.any():
+                    self.assertTrue(np.array_equal(found, find_intersection_set(table, 1).found))
+                else:
+                    self.assertIsNone(found)
+
+                # A player changes its calendar, joins or leaves the group.
+                change = random_state.randint(3)
+                if change == 0:
+                    players_events[random_state.randint(len(player_ids))] = \
+                        generate_random_events(random_state, 5, REPEAT_PERIOD)
+                elif change == 1 or len(player_ids) == 1:
+                    player_ids.append(max(player_ids) + 1)
+                    players_events.append(generate_random_events(random_state, 5, REPEAT_PERIOD))
+                else:
+                    removed = random_state.randint(len(player_ids))
+                    del player_ids[removed]
+                    del players_events[removed]
+
+    def test_only_changed_calendars_are_updated(self):
+        players_events = [np.array([[0, 100, 0]]), np.array([[50, 150, 0]]), np.array([[20, 80, 0]])]
+        index = GroupIntersectionIndex()
+        self.assertEqual(index.update([1, 2, 3], players_events, 0, 1000), 3)
+        self.assertEqual(index.update([1, 2, 3], [events.copy() for events in players_events], 0, 1000), 0)
+        self.assertEqual(index.update([1, 2, 3], players_events[:2] + [np.array([[60, 90, 0]])], 0, 1000), 1)
+        self.assertEqual(index.intersections(0, 1000).tolist(), [[60, 90]])
+        # Members leaving the group, or whose calendar could not be fetched, are no longer taken into account.
+        self.assertEqual(index.update([1, 2], players_events[:2], 0, 1000), 1)
+        self.assertEqual(index.update([1, 2, 3], players_events[:2] + [None], 0, 1000), 0)
+        self.assertEqual(index.intersections(0, 1000).tolist(), [[50, 100]])
+        self.assertEqual(len(index), 2)
+        # A new window starts a new index.
+        self.assertEqual(index.update([1, 2], players_events[:2], 0, 500), 2)
+
+    async def test_indexes_of_groups_are_kept(self):
+        indexes = GroupIndexCache(max_groups=1)
+        players_events = [np.array([[0, 100, 0]]), np.array([[50, 150, 0]])]
+        found = await indexes.get_intersections('a', [1, 2], players_events, 0, 1000, 60)
+        self.assertEqual(found.tolist(), [[60, 100]])
+        await indexes.get_intersections('a', [1, 2, 3], players_events + [np.array([[0, 70, 0]])], 0, 1000, 0)
+        self.assertEqual((indexes.stats()['builds'], indexes.stats()['updates']), (1, 1))
+        self.assertEqual(indexes.stats()['updated_players'], 3)
+        await indexes.get_intersections('b', [1], players_events[:1], 0, 1000, 0)
+        await indexes.get_intersections('a', [1, 2], players_events, 0, 1000, 0)
+        self.assertEqual(indexes.stats()['builds'], 3)
+        self.assertEqual(len(indexes), 1)
+
+    async def test_large_updates_run_in_the_pool_on_a_copy(self):
+        indexes = GroupIndexCache()
+        players_events = [np.array([[0, 100, 0]]), np.array([[50, 150, 0]])]
+        await indexes.get_intersections('a', [1, 2], players_events, 0, 1000, 0)
+        index = indexes._indexes['a']
+        with mock.patch('workers.OFFLOAD_THRESHOLD', 2), \
+                mock.patch('workers.run_cpu_bound', wraps=workers.run_cpu_bound) as run_cpu_bound:
+            # One changed calendar is updated inline, two in the pool.
+            found = await indexes.get_intersections('a', [1, 2], [players_events[0], np.array([[60, 150, 0]])],
+                                                    0, 1000, 0)
+            self.assertEqual(found.tolist(), [[60, 100]])
+            self.assertEqual(run_cpu_bound.call_count, 0)
+            self.assertIs(indexes._indexes['a'], index)
+            found = await indexes.get_intersections('a', [1, 2], [np.array([[0, 90, 0]]), np.array([[70, 80, 0]])],
+                                                    0, 1000, 0)
+            self.assertEqual(run_cpu_bound.call_count, 1)
+        self.assertEqual(found.tolist(), [[70, 80]])
+        self.assertIsNot(indexes._indexes['a'], index)
+        self.assertEqual(index.intersections(0, 1000).tolist(), [[60, 100]])
+        self.assertEqual(indexes.stats()['updated_players'], 5)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 10))
+        for value in [0.5, 1, 5, 20]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'], {'<=1': 2, '<=10': 1, '>10': 1})
+        self.assertEqual((snapshot['count'], snapshot['min'], snapshot['max'], snapshot['mean']), (4, 0.5, 20, 6.625))
+
+    def test_snapshot_holds_stages_counters_and_gauges(self):
+        registry = Metrics()
+        with registry.timer('parse'):
+            pass
+        registry.increment('api_errors')
+        registry.increment('api_errors', 2)
+        registry.register_gauge('cache', lambda: {'hits': 1})
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['stages']['parse']['count'], 1)
+        self.assertEqual(snapshot['counters'], {'api_errors': 3})
+        self.assertEqual(snapshot['cache'], {'hits': 1})
+
+    @mock.patch('bdd_handler.query_bdd_for_player', side_effect=ConnectionError)
+    def test_api_errors_are_counted(self, query_bdd_function):
+        player_cache.clear()
+        errors = metrics.registry.snapshot()['counters'].get('api_errors', 0)
+        with self.assertLogs('core', level='WARNING'):
+            with self.assertRaises(ConnectionError):
+                get_player_json(1, 0, 1000)
+        self.assertEqual(metrics.registry.snapshot()['counters']['api_errors'], errors + 1)
+
+
+class WorkersTestCase(unittest.IsolatedAsyncioTestCase):
+    def tearDown(self):
+        workers.shutdown_executor()
+
+    async def test_small_work_runs_inline(self):
+        thread_name = await workers.run_cpu_bound(workers.OFFLOAD_THRESHOLD - 1, lambda: threading.current_thread().name)
+        self.assertEqual(thread_name, threading.current_thread().name)
+
+    async def test_large_work_runs_in_pool(self):
+        with mock.patch('workers.WORKER_POOL', 'thread'):
+            thread_name = await workers.run_cpu_bound(workers.OFFLOAD_THRESHOLD,
+                                                      lambda: threading.current_thread().name)
+        self.assertTrue(thread_name.startswith('worker'))
+
+    async def test_process_pool(self):
+        calendar = np.asarray([[0, 100], [200, 500]])
+        with mock.patch('workers.WORKER_POOL', 'process'):
+            found = await workers.run_cpu_bound(workers.OFFLOAD_THRESHOLD, find_first_intersection,
+                                                [calendar, calendar], minimum_length=10)
+        self.assertEqual(found, [0, 100])
+
+    @mock.patch('workers.OFFLOAD_THRESHOLD', 0)
+    @mock.patch('bdd_handler.query_bdd_for_player_async', side_effect=query_bdd_for_player_async_mock)
+    async def test_parse_in_pool(self, query_bdd_function):
+        player_cache.clear()
+        players_data = await convert_players_json([298673420181438465, 1], 0, 0, 1100000)
+        self.assertTrue(np.all(players_data[0] == np.asarray([[2, 80000], [170000, 700000]])))
+        self.assertIsNone(players_data[1])
+
+    async def test_shutdown_cancels_work_not_started(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        with mock.patch('workers.WORKER_POOL', 'thread'), mock.patch('workers.WORKER_POOL_SIZE', 1):
+            running = asyncio.ensure_future(workers.run_cpu_bound(workers.OFFLOAD_THRESHOLD, block))
+            queued = asyncio.ensure_future(workers.run_cpu_bound(workers.OFFLOAD_THRESHOLD, block))
+            await asyncio.sleep(0)
+            started.wait(5)
+            workers.shutdown_executor()
+            release.set()
+            await running
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        self.assertEqual(len(workers._pending_futures), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,252 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import core
+import workers
+
+# Maximum number of groups whose index is kept (the least recently polled are dropped first). 0 disables indexes.
+GROUP_INDEX_MAX_GROUPS = int(os.getenv('GROUP_INDEX_MAX_GROUPS', 100))
+
+
+class GroupIntersectionIndex:
+    """
+    Intersection of the availabilities of a group of players, maintained incrementally, so that polls of a group whose
+    calendars barely changed do not intersect all of them again.
+
+    Calendars of players are the leaves of a binary tree, every node of which holds the intersection of the two nodes
+    below it (None standing for no constraint, for free leaves and players who did not fill their availabilities). The
+    root is the intersection of all calendars. When the calendar of a player changes, or when a player is added or
+    removed, only the nodes between its leaf and the root are intersected again: O(log n) intersections of two
+    calendars, rather than a sweep over all of them.
+
+    Calendars are parsed for the window of the index (see update), which is that of a day (see
+    core.get_from_and_to_optimistic), and clipped to polls only when they are queried.
+    """
+    def __init__(self):
+        self.window = None
+        # Player id -> position of its leaf, and positions of free leaves.
+        self._leaves = {}
+        self._free_leaves = [0]
+        # Events arrays the leaves of players were parsed from, to detect calendars which changed.
+        self._events = {}
+        # Nodes of the tree, node i having nodes 2i and 2i+1 below it. Leaf i is node size+i.
+        self._size = 1
+        self._tree = [None, None]
+        self.n_updated = 0
+
+    def __len__(self):
+        return len(self._leaves)
+
+    def clear(self):
+        self._leaves.clear()
+        self._free_leaves[:] = [0]
+        self._events.clear()
+        self._size = 1
+        self._tree = [None, None]
+
+    def _grow(self):
+        """
+        Doubles the number of leaves. The current tree becomes the left half of the new one.
+        """
+        tree = [None] * (4 * self._size)
+        for node in range(1, 2 * self._size):
+            # Nodes keep their rank within their level, the first node of every level moving from 2^d to 2^(d+1).
+            tree[node + (1 << (node.bit_length() - 1))] = self._tree[node]
+        tree[1] = self._tree[1]
+        self._free_leaves.extend(range(2 * self._size - 1, self._size - 1, -1))
+        self._size *= 2
+        self._tree = tree
+
+    def _set_leaf(self, player_id, intervals):
+        """
+        :return: position of the leaf of the player, set to intervals.
+        """
+        leaf = self._leaves.get(player_id)
+        if leaf is None:
+            if len(self._free_leaves) == 0:
+                self._grow()
+            leaf = self._free_leaves.pop()
+            self._leaves[player_id] = leaf
+        self._tree[self._size + leaf] = intervals
+        return leaf
+
+    def _remove(self, player_id):
+        """
+        :return: position of the (former) leaf of the player.
+        """
+        leaf = self._leaves.pop(player_id)
+        self._events.pop(player_id, None)
+        self._free_leaves.append(leaf)
+        self._tree[self._size + leaf] = None
+        return leaf
+
+    def _propagate(self, leaves):
+        """
+        Intersects again the nodes above the given (changed) leaves, level by level up to the root.
+        """
+        nodes = {(self._size + leaf) // 2 for leaf in leaves if self._size > 1}
+        while nodes:
+            for node in nodes:
+                self._tree[node] = core.intersect_calendars(self._tree[2 * node], self._tree[2 * node + 1])
+            nodes = {node // 2 for node in nodes if node > 1}
+
+    def copy(self):
+        """
+        :return: copy of the index, which can be updated without modifying this one. Calendars are shared, as they
+        are replaced rather than modified by updates.
+        """
+        index = GroupIntersectionIndex()
+        index.window = self.window
+        index._leaves = dict(self._leaves)
+        index._free_leaves = list(self._free_leaves)
+        index._events = dict(self._events)
+        index._size = self._size
+        index._tree = list(self._tree)
+        index.n_updated = self.n_updated
+        return index
+
+    def _get_changes(self, player_ids, players_events, start_time, end_time):
+        """
+        :return: ids of players whose events changed since the last update (all of them for a new window), along with
+        their events arrays, and ids of players to remove. See update.
+        """
+        new_window = self.window != (start_time, end_time)
+        changed_ids = []
+        changed_events = []
+        removed_ids = set() if new_window else set(self._leaves).difference(player_ids)
+        for player_id, events in zip(player_ids, players_events):
+            if events is None:
+                if player_id in self._leaves and not new_window:
+                    removed_ids.add(player_id)
+                continue
+            if not isinstance(events, np.ndarray):
+                events = core.events_to_array(events)
+            indexed_events = None if new_window else self._events.get(player_id)
+            if indexed_events is not None and (indexed_events is events or np.array_equal(indexed_events, events)):
+                continue
+            changed_ids.append(player_id)
+            changed_events.append(events)
+        return changed_ids, changed_events, removed_ids
+
+    def count_changed_events(self, player_ids, players_events, start_time, end_time):
+        """
+        :return: number of events of players whose calendars an update would parse again, see update.
+        """
+        _, changed_events, _ = self._get_changes(player_ids, players_events, start_time, end_time)
+        return sum(len(events) for events in changed_events)
+
+    def update(self, player_ids, players_events, start_time, end_time):
+        """
+        Brings the index up to date with the events of the group, fetched between start_time and end_time. Players of
+        the index not in player_ids are removed. Calendars are only parsed and intersected again for players whose
+        events changed since the last update (a whole new window starts a new index).
+
+        :param player_ids: ids of the players of the group.
+        :param players_events: events arrays of the players (see core.events_to_array), None for players to leave out
+        (for instance because their calendar could not be fetched).
+        :return: number of players added, changed or removed.
+        """
+        changed_ids, changed_events, removed_ids = self._get_changes(player_ids, players_events, start_time, end_time)
+        if self.window != (start_time, end_time):
+            self.clear()
+            self.window = (start_time, end_time)
+
+        changed_leaves = [self._remove(player_id) for player_id in removed_ids]
+        if changed_ids:
+            table = core.parse_players_json(changed_events, start_time, end_time)
+            for player_id, events, intervals in zip(changed_ids, changed_events, table):
+                self._events[player_id] = events
+                changed_leaves.append(self._set_leaf(player_id, intervals))
+        self._propagate(changed_leaves)
+        n_updated = len(changed_ids) + len(removed_ids)
+        self.n_updated += n_updated
+        return n_updated
+
+    def intersections(self, start_time, end_time):
+        """
+        :return: np.array of int64 of shape (M,2) of the intervals where all players who filled their availabilities
+        are available, clipped to [start_time, end_time], or None if no player did.
+        """
+        found = self._tree[1]
+        if found is None:
+            return None
+        found = found[(found[:, 1] > start_time) & (found[:, 0] < end_time)]
+        return np.clip(found, start_time, end_time)
+
+
+def build_group_index(player_ids, players_events, start_time, end_time):
+    """
+    :return: new GroupIntersectionIndex of the players, see GroupIntersectionIndex.update.
+    """
+    index = GroupIntersectionIndex()
+    index.update(player_ids, players_events, start_time, end_time)
+    return index
+
+
+def update_group_index(index, player_ids, players_events, start_time, end_time):
+    """
+    :return: updated copy of index, and the number of players updated, see GroupIntersectionIndex.update.
+    """
+    index = index.copy()
+    n_updated = index.update(player_ids, players_events, start_time, end_time)
+    return index, n_updated
+
+
+class GroupIndexCache:
+    """
+    Indexes of the groups polled most recently, by key of the group (typically what the poll targets: guild, roles and
+    members mentioned, and number of weeks), so that members joining or leaving a group update its index rather than
+    starting a new one.
+    """
+    def __init__(self, max_groups=GROUP_INDEX_MAX_GROUPS):
+        self.max_groups = max_groups
+        # group key -> GroupIntersectionIndex, least recently used first.
+        self._indexes = OrderedDict()
+        self.builds = 0
+        self.updates = 0
+        self.updated_players = 0
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def has_index(self, group_key, start_time, end_time):
+        """
+        :return: whether the group has an index for the window from start_time to end_time, which polls can be
+        answered from.
+        """
+        index = self._indexes.get(group_key)
+        return index is not None and index.window == (start_time, end_time)
+
+    async def get_intersections(self, group_key, player_ids, players_events, start_time, end_time, start_time_strict):
+        """
+        Updates the index of the group (building it if needed) and returns its intersections, see
+        GroupIntersectionIndex.update and GroupIntersectionIndex.intersections.
+        Building an index, or updating players with enough events, runs in the worker pool (see
+        workers.run_cpu_bound), on a new index (or a copy of the index) swapped in once done, so that an index is never
+        modified by two polls at once. Updates of a few players run inline, on the event loop.
+        """
+        index = self._indexes.pop(group_key, None)
+        if index is None or index.window != (start_time, end_time):
+            n_events = sum(len(player_events) for player_events in players_events if player_events is not None)
+            index = await workers.run_cpu_bound(n_events, build_group_index, player_ids, players_events, start_time,
+                                                end_time)
+            self.builds += 1
+            self.updated_players += len(index)
+        else:
+            n_events = index.count_changed_events(player_ids, players_events, start_time, end_time)
+            if n_events < workers.OFFLOAD_THRESHOLD:
+                n_updated = index.update(player_ids, players_events, start_time, end_time)
+            else:
+                index, n_updated = await workers.run_cpu_bound(n_events, update_group_index, index, player_ids,
+                                                               players_events, start_time, end_time)
+            self.updated_players += n_updated
+            self.updates += 1
+        if self.max_groups > 0:
+            self._indexes[group_key] = index
+            while len(self._indexes) > self.max_groups:
+                self._indexes.popitem(last=False)
+        return index.intersections(start_time_strict, end_time)
+
+    def stats(self):
+        return {'groups': len(self._indexes), 'players': sum(len(index) for index in self._indexes.values()),
+                'builds': self.builds, 'updates': self.updates, 'updated_players': self.updated_players}
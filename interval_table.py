@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class IntervalTable:
+    """
+    Intervals of a group of players, as a single struct of arrays: starts and ends (int64 timestamps) of the intervals
+    of all players, player after player, and offsets, such that the intervals of player i are those between
+    offsets[i] and offsets[i+1] (as the rows of a CSR matrix). Players who did not fill their availabilities (None in
+    lists of arrays) have no intervals, and are flagged as not valid.
+
+    This is the form calendars go through core in, from parsing to intersection engines. Indexing a table (table[i]) or
+    iterating over it gives, for every player, the (N,2) array of its intervals or None, so that it can still be used
+    where lists of arrays are expected.
+    """
+    def __init__(self, starts, ends, offsets, valid=None):
+        """
+        :param starts: np.array of shape (T,), starts of the intervals of all players.
+        :param ends: np.array of shape (T,), ends of the intervals of all players.
+        :param offsets: np.array of shape (n_players + 1,), starting with 0 and ending with T.
+        :param valid: np.array of bool of shape (n_players,), False for players who did not fill their availabilities.
+        All players are valid if None.
+        """
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if valid is None:
+            valid = np.ones(self.offsets.shape[0] - 1, dtype=bool)
+        self.valid = np.asarray(valid, dtype=bool)
+
+    @classmethod
+    def from_arrays(cls, intervals):
+        """
+        Builds the table of a list of players, given as np.array of shape (N,2) of their intervals, or None.
+        """
+        counts = np.zeros(len(intervals), dtype=np.int64)
+        valid = np.zeros(len(intervals), dtype=bool)
+        valid_players = []
+        for i, player_i in enumerate(intervals):
+            if player_i is not None:
+                if len(player_i.shape) != 2:
+                    raise ValueError('interval of player should confirm to shape (N,2), where N is the number of '
+                                     'intervals of the player, got shape {} instead'.format(player_i.shape))
+                counts[i] = player_i.shape[0]
+                valid[i] = True
+                valid_players.append(player_i)
+        all_intervals = np.concatenate(valid_players, axis=0) if valid_players else np.empty((0, 2), dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls(all_intervals[:, 0], all_intervals[:, 1], offsets, valid)
+
+    def __len__(self):
+        return self.valid.shape[0]
+
+    def __getitem__(self, i):
+        if not self.valid[i]:
+            return None
+        return np.column_stack((self.starts[self.offsets[i]:self.offsets[i + 1]],
+                                self.ends[self.offsets[i]:self.offsets[i + 1]]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def n_intervals(self):
+        return self.starts.shape[0]
+
+    def counts(self):
+        """
+        :return: np.array of shape (n_players,), number of intervals of every player.
+        """
+        return np.diff(self.offsets)
+
+    def owners(self):
+        """
+        :return: np.array of shape (T,), index of the player every interval belongs to.
+        """
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def select(self, indices):
+        """
+        :return: table of the players of the given indices, in this order.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.counts()[indices]
+        # Positions of the intervals of selected players, player after player.
+        first = np.repeat(self.offsets[indices] - (np.cumsum(counts) - counts), counts)
+        positions = first + np.arange(first.shape[0])
+        return IntervalTable(self.starts[positions], self.ends[positions], np.concatenate(([0], np.cumsum(counts))),
+                             self.valid[indices])
@@ -0,0 +1,256 @@
+"""
+End to end load test of the bot: many concurrent polls, across simulated guilds, go through CustomBot.start_poll as if
+issued on Discord, and calendars are served over HTTP by a local stand-in of the availability API (see
+bdd_server_mock.MockBddServer), so that it runs offline.
+
+Every poll mentions a random role of a random guild, through a fake context recording the messages the bot sends.
+Calendars are synthetic (see bdd_handler_mock.SyntheticBdd), and the stand-in answers after --latency seconds, failing
+a fraction --error-rate of requests with an error 500.
+
+Reported (as JSON, printed or written to --output):
+- throughput: polls completed per second,
+- latency: p50, p99 and max time (in seconds) from a poll being issued to its last message,
+- loop: time the event loop was blocked, measured by a coroutine waking up every --loop-interval seconds and recording
+  how late it wakes up (max and p99 lag, and total lag beyond the interval),
+- outcomes: number of polls per kind of result (see classify_outcome, 'failed' for polls which raised), and number
+  of polls which left out members whose calendar could not be fetched in time (unreachable), and errors raised by
+  polls,
+- requests: number of requests served by the stand-in, and metrics of the bot (see metrics.registry).
+
+python load_test.py --guilds 10 --members 500 --polls 200 --concurrency 20 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import bdd_handler
+import core
+from bot import CustomBot
+from metrics import registry as metrics
+from member_index import MemberIndex
+from group_index import GroupIndexCache
+from bdd_handler_mock import SyntheticBdd
+from bdd_server_mock import MockBddServer
+
+
+class FakeMessage:
+    """
+    Message sent by the bot, which it can edit (to show progress of polls).
+    """
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content):
+        self.content = content
+
+
+class FakeContext:
+    """
+    Minimal stand-in for a discord.py context: the message of a command (guild, channel, mentions and content), and
+    send, recording the messages sent by the bot.
+    """
+    def __init__(self, guild, channel_id, content, mentions=(), roles=(), everyone=False):
+        self.message = SimpleNamespace(guild=guild, channel=SimpleNamespace(id=channel_id), content=content,
+                                       mentions=list(mentions), role_mentions=list(roles), mention_everyone=everyone)
+        self.sent = []
+
+    async def send(self, content):
+        message = FakeMessage(content)
+        self.sent.append(message)
+        return message
+
+
+def generate_guilds(random_state, n_guilds, n_members, n_roles, roles_per_member):
+    """
+    Generates n_guilds guilds of n_members members each, holding roles_per_member roles out of n_roles. Ids of members
+    are distinct across guilds, so that every member has its own calendar.
+    :return: list of (guild, roles)
+    """
+    guilds = []
+    for guild_id in range(1, n_guilds + 1):
+        guild = SimpleNamespace(id=guild_id, members=[])
+        roles = [SimpleNamespace(id=guild_id * 1000 + role_id, guild=guild) for role_id in range(1, n_roles + 1)]
+        for member_id in range(n_members):
+            member_roles = [roles[i] for i in random_state.choice(n_roles, size=roles_per_member, replace=False)]
+            guild.members.append(SimpleNamespace(id=guild_id * 10 ** 9 + member_id, roles=member_roles, bot=False,
+                                                 guild=guild))
+        guilds.append((guild, roles))
+    return guilds
+
+
+class LoopMonitor:
+    """
+    Measures how long the event loop is blocked: a coroutine sleeps interval seconds at a time, and records how late it
+    wakes up. A loop never blocked wakes it up on time, a computation holding the loop delays it by its duration.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+
+    async def run(self):
+        """
+        Records lags until cancelled.
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.perf_counter() - start - self.interval, 0.0))
+
+    def stats(self):
+        lags = np.asarray(self.lags) if self.lags else np.zeros(1)
+        return {'interval': self.interval, 'samples': len(self.lags), 'max_lag': float(lags.max()),
+                'p99_lag': float(np.percentile(lags, 99)), 'blocked_time': float(lags.sum())}
+
+
+def classify_outcome(ctx):
+    """
+    :return: kind of result of a poll, from the messages sent to its context: 'session' (found), 'no_session',
+    'timed_out', 'cancelled' or 'other'.
+    """
+    messages = [message.content for message in ctx.sent]
+    if any('took more than' in message for message in messages):
+        return 'timed_out'
+    if 'Poll cancelled.' in messages:
+        return 'cancelled'
+    if any('next session (' in message or 'would be:' in message for message in messages):
+        return 'session'
+    if any("can't be" in message or 'can be scheduled' in message or "Couldn't find" in message
+           for message in messages):
+        return 'no_session'
+    return 'other'
+
+
+async def run_polls(guilds, n_polls, concurrency, options, random_state):
+    """
+    Issues n_polls polls, at most concurrency at once, each mentioning a random role of a random guild.
+    :return: (latencies of polls in seconds, outcomes of polls, errors raised by polls (error -> count), total time in
+    seconds)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    outcomes = {}
+    errors = {}
+    polls = []
+    for i in range(n_polls):
+        guild, roles = guilds[random_state.randint(len(guilds))]
+        role = roles[random_state.randint(len(roles))]
+        polls.append(FakeContext(guild, i, ' '.join(['-startpoll', '<@&{}>'.format(role.id)] + options),
+                                 roles=[role]))
+
+    async def run_poll(ctx):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await CustomBot.start_poll.callback(ctx)
+                outcome = classify_outcome(ctx)
+            except Exception as error:
+                outcome = 'failed'
+                errors[repr(error)] = errors.get(repr(error), 0) + 1
+            latencies.append(time.perf_counter() - start)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if any('could not be reached in time' in message.content for message in ctx.sent):
+                outcomes['unreachable'] = outcomes.get('unreachable', 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_poll(ctx) for ctx in polls])
+    return latencies, outcomes, errors, time.perf_counter() - start
+
+
+async def _run_load_test(guilds, n_polls, concurrency, options, loop_interval, random_state):
+    monitor = LoopMonitor(loop_interval)
+    monitor_task = asyncio.ensure_future(monitor.run())
+    try:
+        latencies, outcomes, errors, total_time = await run_polls(guilds, n_polls, concurrency, options, random_state)
+    finally:
+        monitor_task.cancel()
+        await bdd_handler.close_session()
+    return latencies, outcomes, errors, total_time, monitor.stats()
+
+
+def run_load_test(n_guilds=5, n_members=200, n_roles=10, roles_per_member=2, n_polls=100, concurrency=10,
+                  latency=0.05, error_rate=0.0, n_events=20, overlap_density=0.9, options=(), loop_interval=0.01,
+                  seed=0):
+    """
+    Runs the load test, see the documentation of the module. The cache of calendars is cleared before the run.
+    :param options: options of the polls, as typed after -startpoll (for instance ['-t', '01:00', '-n', '3']).
+    :return: dict of results.
+    """
+    random_state = np.random.RandomState(seed)
+    guilds = generate_guilds(random_state, n_guilds, n_members, n_roles, roles_per_member)
+    bdd = SyntheticBdd(n_events, overlap_density, seed=seed)
+    errors_random_state = np.random.RandomState(seed + 1)
+    lock = threading.Lock()
+
+    def events_provider(player_id, start_time, end_time):
+        # The stand-in answers requests in several threads.
+        with lock:
+            if errors_random_state.rand() < error_rate:
+                raise RuntimeError('Simulated failure of the API')
+            return bdd.get_calendar(player_id, start_time, end_time)
+
+    core.player_cache.clear()
+    with MockBddServer(latency=latency, events_provider=events_provider) as server:
+        with mock.patch('core.BDD_URL', server.url), mock.patch('core.snapshot_store', None), \
+                mock.patch('bot.member_index', MemberIndex()), mock.patch('bot.group_indexes', GroupIndexCache()):
+            latencies, outcomes, errors, total_time, loop = asyncio.run(
+                _run_load_test(guilds, n_polls, concurrency, list(options), loop_interval, random_state))
+        n_requests = server.n_requests
+    core.player_cache.clear()
+
+    latencies = np.asarray(latencies)
+    return {
+        'parameters': {'guilds': n_guilds, 'members': n_members, 'roles': n_roles, 'roles_per_member': roles_per_member,
+                       'polls': n_polls, 'concurrency': concurrency, 'latency': latency, 'error_rate': error_rate,
+                       'events_per_player': n_events, 'overlap_density': overlap_density, 'options': list(options)},
+        'throughput': n_polls / total_time,
+        'total_time': total_time,
+        'latency': {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                    'max': float(latencies.max())},
+        'loop': loop,
+        'outcomes': outcomes,
+        'errors': errors,
+        'requests': n_requests,
+        'metrics': metrics.snapshot(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load tests the bot with concurrent polls on simulated guilds.')
+    parser.add_argument('--guilds', type=int, default=5, help='number of guilds')
+    parser.add_argument('--members', type=int, default=200, help='members per guild')
+    parser.add_argument('--roles', type=int, default=10, help='roles per guild')
+    parser.add_argument('--roles-per-member', type=int, default=2, help='roles held by every member')
+    parser.add_argument('--polls', type=int, default=100, help='number of polls')
+    parser.add_argument('--concurrency', type=int, default=10, help='maximum number of polls running at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of the API stand-in (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with an error 500')
+    parser.add_argument('--events', type=int, default=20, help='events per player (size of payloads)')
+    parser.add_argument('--overlap-density', type=float, default=0.9, help='fraction of the window players are free')
+    parser.add_argument('--options', default='', help='options of the polls, for instance "-t 01:00 -n 3"')
+    parser.add_argument('--loop-interval', type=float, default=0.01, help='interval of the event loop monitor (s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the simulation')
+    parser.add_argument('--output', help='file to write results to (default: standard output)')
+    parser.add_argument('--log-level', default='ERROR', help='level of logs of the bot (failed queries are warnings)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    results = run_load_test(args.guilds, args.members, args.roles, args.roles_per_member, args.polls,
+                            args.concurrency, args.latency, args.error_rate, args.events, args.overlap_density,
+                            args.options.split(), args.loop_interval, args.seed)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+class MemberIndex:
+    """
+    Index of the members of guilds by role (role id -> ids of members with this role), so that resolving the members
+    of interest of a poll costs the size of the roles mentioned, rather than a scan of all members of the guild for
+    every role. Bots are not indexed: they never fill availabilities.
+
+    The index of a guild is built on first use, from guild.members, and kept up to date by the bot from the events of
+    Discord (members joining, leaving or changing roles, roles being deleted).
+    """
+    def __init__(self):
+        # guild id -> (ids of members, {role id -> ids of members with this role})
+        self._guilds = {}
+
+    def _get_guild_index(self, guild):
+        guild_index = self._guilds.get(guild.id)
+        if guild_index is None:
+            guild_index = (set(), {})
+            self._guilds[guild.id] = guild_index
+            for member in guild.members:
+                self._add(guild_index, member)
+        return guild_index
+
+    @staticmethod
+    def _add(guild_index, member):
+        if member.bot:
+            return
+        member_ids, roles = guild_index
+        member_ids.add(member.id)
+        for role in member.roles:
+            roles.setdefault(role.id, set()).add(member.id)
+
+    @staticmethod
+    def _remove(guild_index, member):
+        member_ids, roles = guild_index
+        member_ids.discard(member.id)
+        for role in member.roles:
+            role_member_ids = roles.get(role.id)
+            if role_member_ids is not None:
+                role_member_ids.discard(member.id)
+
+    def add_member(self, member):
+        guild_index = self._guilds.get(member.guild.id)
+        if guild_index is not None:
+            self._add(guild_index, member)
+
+    def remove_member(self, member):
+        guild_index = self._guilds.get(member.guild.id)
+        if guild_index is not None:
+            self._remove(guild_index, member)
+
+    def update_member(self, before, after):
+        guild_index = self._guilds.get(after.guild.id)
+        if guild_index is not None:
+            self._remove(guild_index, before)
+            self._add(guild_index, after)
+
+    def remove_role(self, role):
+        guild_index = self._guilds.get(role.guild.id)
+        if guild_index is not None:
+            guild_index[1].pop(role.id, None)
+
+    def forget_guild(self, guild):
+        """
+        Drops the index of the guild, which is built again on its next use.
+        """
+        self._guilds.pop(guild.id, None)
+
+    def resolve(self, guild, roles=(), mentions=(), everyone=False):
+        """
+        :return: set of the ids of members of the guild who are mentioned, have one of the roles, or of all members if
+        everyone is True. Bots are left out.
+        """
+        member_ids, role_member_ids = self._get_guild_index(guild)
+        if everyone:
+            return set(member_ids)
+        resolved = {member.id for member in mentions if not member.bot}
+        for role in roles:
+            # The default role (@everyone) has the id of the guild, and is held by all members.
+            resolved.update(member_ids if role.id == guild.id else role_member_ids.get(role.id, ()))
+        return resolved
+
+    def stats(self):
+        return {'guilds': len(self._guilds), 'members': sum(len(member_ids) for member_ids, _ in self._guilds.values())}
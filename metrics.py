@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the buckets of histograms. The last bucket holds everything above.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Distribution of durations (or of any other positive values), with fixed buckets.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        labels = ['<={}'.format(bound) for bound in self.buckets] + ['>{}'.format(self.buckets[-1])]
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class Metrics:
+    """
+    Registry of the metrics of the bot: histograms of the duration of the stages of polls (member resolution, fetch,
+    parse, intersect, render) and of single queries to the BDD (api_request), counters (such as API errors), and
+    gauges, which are callables returning a dict read when a snapshot is taken (such as statistics of the cache).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, stage, duration):
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(duration)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Context manager recording the time spent in its body in the histogram of stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def register_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """
+        :return: dict of all metrics, serializable to JSON.
+        """
+        with self._lock:
+            snapshot = {'stages': {stage: histogram.snapshot() for stage, histogram in self.histograms.items()},
+                        'counters': dict(self.counters)}
+        snapshot.update({name: function() for name, function in self.gauges.items()})
+        return snapshot
+
+    def write(self, path):
+        """
+        Writes a snapshot of all metrics to path, as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+# Metrics of the bot, shared by all modules.
+registry = Metrics()
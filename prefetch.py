@@ -0,0 +1,156 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+from collections import OrderedDict
+import core
+
+logger = logging.getLogger(__name__)
+
+# Time (in seconds) between two rounds of prefetching.
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', 60))
+
+# Time (in seconds) ahead of an expected poll from which calendars of its members are prefetched. Must be shorter than
+# the time calendars are cached for (CACHE_TTL, see core.player_cache), otherwise they expire before the poll.
+PREFETCH_LEAD = float(os.getenv('PREFETCH_LEAD', 240))
+
+# Maximum number of queries to the BDD per round. 0 disables prefetching.
+PREFETCH_BUDGET = int(os.getenv('PREFETCH_BUDGET', 100))
+
+# Maximum number of groups of members remembered, and time (in seconds) after which a group which was not polled
+# again is forgotten.
+PREFETCH_MAX_GROUPS = int(os.getenv('PREFETCH_MAX_GROUPS', 1000))
+PREFETCH_GROUP_TTL = float(os.getenv('PREFETCH_GROUP_TTL', 4 * 7 * 24 * 3600))
+
+# Polls of a group are expected to happen again at the same time of the week.
+WEEK = 7 * 24 * 3600
+
+
+def get_poll_window(timestamp, n_weeks):
+    """
+    :return: (start_time, end_time) of the calendars fetched by a poll over n_weeks issued at timestamp (in seconds),
+    as computed by CustomBot.compute_poll.
+    """
+    return core.get_from_and_to_optimistic(datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc), n_weeks)
+
+
+class PrefetchScheduler:
+    """
+    Refreshes calendars of members ahead of the polls they are expected in, so that interactive polls find them in the
+    cache rather than waiting for the BDD.
+
+    Polls are recorded (members and number of weeks), and every group of members is expected to be polled again a
+    week after its last poll. From lead seconds before that, calendars of its members which are not cached until then
+    are fetched from the BDD, one at a time and at most budget per round, so that prefetching never competes much with
+    polls for the BDD. Rounds are skipped while busy() is True (typically while polls are running).
+
+    The hit rate is the fraction of members of recorded polls whose calendar had been prefetched for the window of the
+    poll, and is still cached when the poll starts.
+    """
+    def __init__(self, budget=PREFETCH_BUDGET, lead=PREFETCH_LEAD, interval=PREFETCH_INTERVAL,
+                 max_groups=PREFETCH_MAX_GROUPS, group_ttl=PREFETCH_GROUP_TTL, busy=lambda: False, clock=time.time):
+        """
+        :param busy: callable returning True when prefetching should wait.
+        :param clock: callable returning the current (wall clock) time in seconds. Meant to be overridden in tests.
+        """
+        self.budget = budget
+        self.lead = lead
+        self.interval = interval
+        self.max_groups = max_groups
+        self.group_ttl = group_ttl
+        self.busy = busy
+        self.clock = clock
+        # frozenset of member ids -> (n_weeks, time of the last poll), least recently polled first.
+        self._groups = OrderedDict()
+        # player id -> window of the calendar prefetched, until a poll uses it.
+        self._prefetched = {}
+        self.polled_members = 0
+        self.hits = 0
+        self.prefetched = 0
+        self.errors = 0
+
+    def record(self, member_ids, n_weeks):
+        """
+        Records a poll of the members over n_weeks, issued now, before it fetches their calendars.
+        """
+        now = self.clock()
+        window = get_poll_window(now, n_weeks)
+        for member_id in member_ids:
+            # Prefetched calendars which expired since are fetched by the poll: they are not hits.
+            if self._prefetched.pop(member_id, None) == window and core.player_cache.covers(member_id, *window):
+                self.hits += 1
+        self.polled_members += len(member_ids)
+
+        group = frozenset(member_ids)
+        self._groups.pop(group, None)
+        self._groups[group] = (n_weeks, now)
+        while len(self._groups) > self.max_groups:
+            self._groups.popitem(last=False)
+
+    def get_due_fetches(self):
+        """
+        :return: list of (player_id, start_time, end_time) of calendars to prefetch, those of the soonest polls first.
+        Calendars already cached until the poll are left out.
+        """
+        now = self.clock()
+        due_polls = []
+        for group, (n_weeks, polled_at) in list(self._groups.items()):
+            if now - polled_at > self.group_ttl:
+                del self._groups[group]
+                continue
+            # Next time of the week of the last poll.
+            expected_at = polled_at + max(-((polled_at - now) // WEEK), 1) * WEEK
+            if expected_at - now <= self.lead:
+                due_polls.append((expected_at, group, get_poll_window(expected_at, n_weeks)))
+        due_polls.sort(key=lambda due_poll: due_poll[0])
+
+        fetches = []
+        seen = set()
+        for expected_at, group, (start_time, end_time) in due_polls:
+            for member_id in group:
+                if member_id in seen or self._prefetched.get(member_id) == (start_time, end_time) \
+                        or core.player_cache.covers(member_id, start_time, end_time, margin=expected_at - now):
+                    continue
+                seen.add(member_id)
+                fetches.append((member_id, start_time, end_time))
+        return fetches
+
+    async def prefetch(self):
+        """
+        Runs a round of prefetching.
+        :return: number of queries made.
+        """
+        if self.busy():
+            return 0
+        n_queries = 0
+        for player_id, start_time, end_time in self.get_due_fetches()[:self.budget]:
+            if self.busy():
+                break
+            n_queries += 1
+            try:
+                # Cached calendars due are those which would expire before the poll: they are fetched again anyway.
+                await core.refresh_player_json_async(player_id, start_time, end_time)
+            except Exception:
+                # Already logged by core, the calendar is fetched by the poll instead.
+                self.errors += 1
+                continue
+            self._prefetched[player_id] = (start_time, end_time)
+            self.prefetched += 1
+        return n_queries
+
+    async def run(self):
+        """
+        Runs rounds of prefetching every interval seconds, until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.prefetch()
+            except Exception:
+                logger.warning('Prefetching failed', exc_info=True)
+
+    def stats(self):
+        return {'groups': len(self._groups), 'prefetched': self.prefetched, 'errors': self.errors,
+                'polled_members': self.polled_members, 'hits': self.hits,
+                'hit_rate': self.hits / self.polled_members if self.polled_members else None}
@@ -0,0 +1,57 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls doing the same work: while the work of a key is in flight, other calls with the same
+    key wait for its result instead of doing the work again. Once it completes, the next call with this key does the
+    work anew (caching results is left to callers).
+    """
+    def __init__(self, cancel_abandoned=True):
+        """
+        :param cancel_abandoned: whether to cancel the work of a key once all calls waiting for it are cancelled, rather
+        than let it complete in the background.
+        """
+        self.cancel_abandoned = cancel_abandoned
+        # key -> task doing the work, and task -> number of calls waiting for it.
+        self._in_flight = {}
+        self._waiters = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key, function):
+        """
+        Returns the result of await function(), or of the call already in flight for key, if any. Errors are raised to
+        all callers sharing the call.
+        The work runs in its own task: cancelling one of the callers does not cancel it for the others. Cancelling the
+        last caller waiting for it cancels it too, unless cancel_abandoned is False.
+        """
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self._in_flight[key] = task
+            self._waiters[task] = 0
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.coalesced += 1
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.cancel_abandoned and not task.done() and self._waiters[task] == 1:
+                # Later calls do the work anew rather than wait for the cancelled one.
+                self._forget(key, task)
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] == 0:
+                del self._waiters[task]
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._in_flight)}
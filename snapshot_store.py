@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class SnapshotStore:
+    """
+    Persistent store of the calendars fetched from the BDD, so that a restarted bot does not have to query the BDD for
+    every member at once. Calendars are stored in SQLite, as the raw bytes of their int64 events array (see
+    core.events_to_array), so that reading them back does not parse any JSON.
+
+    There is a single snapshot per player, holding the events fetched for a given time window, and the (wall clock)
+    time they were fetched at. Deciding whether a snapshot is too old is left to callers.
+    """
+    def __init__(self, path):
+        """
+        :param path: path of the SQLite database, created if needed. ':memory:' keeps it in memory (for tests).
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS snapshots (player_id TEXT PRIMARY KEY, '
+                                     'start_time INTEGER, end_time INTEGER, fetched_at REAL, events BLOB)')
+
+    def get(self, player_id, start_time, end_time):
+        """
+        :return: (events, fetched_at) of the player if its snapshot covers [start_time, end_time], None otherwise.
+        Events are those of the whole snapshot, callers slice them to the requested window.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT start_time, end_time, fetched_at, events FROM snapshots '
+                                           'WHERE player_id = ?', (str(player_id),)).fetchone()
+        if row is None or row[0] > start_time or row[1] < end_time:
+            return None
+        events = np.frombuffer(row[3], dtype=np.int64).reshape(-1, 3)
+        return events, row[2]
+
+    def put(self, player_id, start_time, end_time, events, fetched_at=None):
+        """
+        Stores the events of the player fetched between start_time and end_time, replacing its previous snapshot.
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+        blob = np.ascontiguousarray(events, dtype=np.int64).tobytes()
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)',
+                                     (str(player_id), int(start_time), int(end_time), fetched_at, blob))
+
+    def put_many(self, snapshots):
+        """
+        Stores several snapshots in a single transaction, see put.
+        :param snapshots: iterable of (player_id, start_time, end_time, events, fetched_at).
+        """
+        rows = [(str(player_id), int(start_time), int(end_time), fetched_at,
+                 np.ascontiguousarray(events, dtype=np.int64).tobytes())
+                for player_id, start_time, end_time, events, fetched_at in snapshots]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)', rows)
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM snapshots')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
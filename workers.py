@@ -0,0 +1,61 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Kind of pool CPU bound work (parsing, intersections) is sent to: 'thread', 'process', or 'none' to always run it
+# inline, on the event loop.
+WORKER_POOL = os.getenv('WORKER_POOL', 'thread')
+
+# Number of workers of the pool.
+WORKER_POOL_SIZE = int(os.getenv('WORKER_POOL_SIZE', 2))
+
+# Size (number of events or intervals) below which work runs inline: sending it to the pool would cost more than
+# running it.
+OFFLOAD_THRESHOLD = int(os.getenv('OFFLOAD_THRESHOLD', 20000))
+
+_executor = None
+# Computations sent to the pool and not done yet, to cancel those not started when the pool is shut down.
+_pending_futures = set()
+
+
+def get_executor():
+    """
+    Returns the pool CPU bound work is sent to, creating it if needed.
+    """
+    global _executor
+    if _executor is None:
+        if WORKER_POOL == 'process':
+            _executor = ProcessPoolExecutor(max_workers=WORKER_POOL_SIZE)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE, thread_name_prefix='worker')
+    return _executor
+
+
+async def run_cpu_bound(size, function, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs) in the worker pool if size is at least OFFLOAD_THRESHOLD, inline otherwise, so that
+    large computations do not block the event loop.
+    With a process pool, function and its arguments must be picklable (module level functions and numpy arrays are).
+    Cancelling the returned coroutine stops waiting for the result, but cannot interrupt a computation already running
+    in the pool.
+    """
+    if WORKER_POOL == 'none' or size < OFFLOAD_THRESHOLD:
+        return function(*args, **kwargs)
+    future = get_executor().submit(functools.partial(function, *args, **kwargs))
+    _pending_futures.add(future)
+    future.add_done_callback(_pending_futures.discard)
+    return await asyncio.wrap_future(future)
+
+
+def shutdown_executor():
+    """
+    Shuts the pool down, if any, without waiting for running computations.
+    """
+    global _executor
+    if _executor is not None:
+        # Executor.shutdown only cancels computations not started yet (cancel_futures) from Python 3.9 on.
+        for future in list(_pending_futures):
+            future.cancel()
+        _executor.shutdown(wait=False)
+    _executor = None